@@ -70,7 +70,7 @@ class MediaFileAdmin(admin.ModelAdmin):
 
     def file_preview(self, obj):
         if obj.file_type == 'image':
-            return format_html('<img src="{}" height="50" />', obj.thumbnail.url)
+            return format_html('<img src="{}" height="50" />', obj.thumbnail_url)
         elif obj.file_type == 'html':
             return format_html('<span class="file-icon">🌐</span>')
         elif obj.file_type == 'document':
@@ -1,6 +1,7 @@
 # media_library/api_views.py
 from django.conf import settings
-from django.http import JsonResponse
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import JsonResponse, StreamingHttpResponse
 from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
@@ -13,8 +14,11 @@ from rest_framework import viewsets
 from rest_framework.exceptions import ValidationError
 
 from .filterset import MediaFileFilter
-from .models import MediaCategory, MediaFile, MediaUsage
+from .models import MediaCategory, MediaFile, MediaUsage, ProcessingStatus
+from .progress import get_progress, watch_progress
+from .renditions import rendition_names
 from .serializers import MediaFileSerializer
+from .storage import is_s3, s3_pool_stats
 
 # @csrf_exempt
 class MediaFileViewSet(viewsets.ModelViewSet):
@@ -74,17 +78,22 @@ def upload_media(request):
             'file_type': media_file.file_type,
         }
 
-        # Add thumbnail URLs for images
+        # Renditions of images are rendered in the background (queued when the
+        # media was saved), so there are no thumbnail/medium URLs to return yet
         if media_file.file_type == 'image':
             response_data.update({
-                'thumbnail_url': request.build_absolute_uri(media_file.thumbnail.url),
-                'medium_url': request.build_absolute_uri(media_file.medium.url),
+                'width': media_file.width,
+                'height': media_file.height,
+                'renditions_ready': media_file.renditions_ready,
+                'detail_url': request.build_absolute_uri(
+                    reverse('media_library:api_media_detail', kwargs={'pk': media_file.id})
+                ),
+                'message': 'Renditions are being generated; get their URLs from detail_url once renditions_ready',
             })
 
-        # If HTML website, start processing in background
+        # HTML websites are extracted in the background (queued when the media was saved)
         if is_html and media_file.file.name.lower().endswith('.zip'):
-            from .tasks import process_html_zip_file
-            process_html_zip_file.send(media_file.id)
+            response_data['processing_status'] = media_file.processing_status
             response_data['message'] = 'HTML website is being processed'
 
         return JsonResponse(response_data)
@@ -222,9 +231,23 @@ def remove_media_usage(request):
         }, status=500)
 
 
+def _rendition_urls(request, media):
+    """
+    ``{rendition: {extension: absolute URL}}`` of every stored format of each
+    rendition of ``media``, smallest first, for the client to pick from
+    (each empty until renditions_ready).
+    """
+    return {
+        name: {fmt: request.build_absolute_uri(url) for fmt, url in media.rendition_urls(name).items()}
+        for name in rendition_names(MediaFile)
+    }
+
+
 def media_list(request):
     """
     API endpoint to get a list of media files, with filtering options.
+    Images list the URL of each rendition in every stored format, under
+    'renditions'; thumbnail_url and medium_url are the JPEGs.
 
     Query parameters:
     - q: Search term
@@ -281,8 +304,13 @@ def media_list(request):
 
         # Add thumbnail URLs for images
         if media.file_type == 'image':
-            media_data['thumbnail_url'] = request.build_absolute_uri(media.thumbnail.url)
-            media_data['medium_url'] = request.build_absolute_uri(media.medium.url)
+            media_data['width'] = media.width
+            media_data['height'] = media.height
+            media_data['placeholder'] = media.placeholder
+            media_data['renditions_ready'] = media.renditions_ready
+            media_data['thumbnail_url'] = request.build_absolute_uri(media.thumbnail_url)
+            media_data['medium_url'] = request.build_absolute_uri(media.medium_url)
+            media_data['renditions'] = _rendition_urls(request, media)
 
         results.append(media_data)
 
@@ -298,6 +326,8 @@ def media_list(request):
 def media_detail(request, pk):
     """
     API endpoint to get details for a specific media file.
+    Images list the URL of each rendition in every stored format, under
+    'renditions'; thumbnail_url and medium_url are the JPEGs.
     """
     try:
         media = MediaFile.objects.get(pk=pk)
@@ -323,8 +353,12 @@ def media_detail(request, pk):
             response.update({
                 'width': media.width,
                 'height': media.height,
-                'thumbnail_url': request.build_absolute_uri(media.thumbnail.url),
-                'medium_url': request.build_absolute_uri(media.medium.url),
+                'placeholder': media.placeholder,
+                # Until then the rendition URLs are the static placeholder
+                'renditions_ready': media.renditions_ready,
+                'thumbnail_url': request.build_absolute_uri(media.thumbnail_url),
+                'medium_url': request.build_absolute_uri(media.medium_url),
+                'renditions': _rendition_urls(request, media),
             })
 
         # Add HTML-specific fields
@@ -370,3 +404,80 @@ def category_list(request):
         return JsonResponse({
             'error': str(e)
         }, status=500)
+
+
+# Processing statuses after which a site's status no longer changes
+FINISHED_STATUSES = (ProcessingStatus.READY, ProcessingStatus.FAILED)
+
+
+def _media_status(pk, progress):
+    """``progress`` as reported by the extraction, or the status stored on the media (None if missing)."""
+    if progress is None:
+        row = MediaFile.objects.filter(pk=pk).values('processing_status', 'processing_error').first()
+        if row is None:
+            return None
+        progress = {'status': row['processing_status'], 'error': row['processing_error']}
+    return {'id': pk, **progress}
+
+
+def media_status(request, pk):
+    """
+    API endpoint reporting how far the processing of a media file is.
+
+    Served from the progress extraction publishes to Redis, so polling it while a
+    site extracts costs no database queries.
+    """
+    status = _media_status(pk, get_progress(pk))
+    if status is None:
+        return JsonResponse({'error': f"Media with ID {pk} not found"}, status=404)
+    response = JsonResponse(status)
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+def _status_events(pk):
+    updates = watch_progress(pk, settings.HTML_SITE_PROGRESS_STREAM_TIMEOUT)
+    try:
+        # The current state (which may predate any progress), then every update
+        status = _media_status(pk, next(updates))
+        if status is None:
+            return
+        yield f"data: {json.dumps(status)}\n\n"
+        if status['status'] in FINISHED_STATUSES:
+            return
+        for progress in updates:
+            if progress is None:
+                # A comment line, so proxies don't time the idle stream out
+                yield ": keep-alive\n\n"
+                continue
+            yield f"data: {json.dumps({'id': pk, **progress})}\n\n"
+            if progress['status'] in FINISHED_STATUSES:
+                return
+    finally:
+        updates.close()
+
+
+def media_status_stream(request, pk):
+    """
+    Server-sent events stream of media_status, ending once processing is done
+    or after HTML_SITE_PROGRESS_STREAM_TIMEOUT seconds (clients reconnect).
+    """
+    if not settings.HTML_SITE_PROGRESS_STREAM or not settings.REDIS_URL:
+        return JsonResponse({'error': 'Status streaming is disabled'}, status=404)
+    if not MediaFile.objects.filter(pk=pk).exists():
+        return JsonResponse({'error': f"Media with ID {pk} not found"}, status=404)
+    response = StreamingHttpResponse(_status_events(pk), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Sent on as produced rather than buffered by nginx
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@staff_member_required
+def storage_pool_stats(request):
+    """
+    API endpoint showing how this worker process uses its S3 connection pool.
+    """
+    if not is_s3():
+        return JsonResponse({'error': 'Media storage is not S3'}, status=404)
+    return JsonResponse(s3_pool_stats())
@@ -0,0 +1,326 @@
+# media_library/cache.py
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, fields
+from datetime import datetime
+
+from django.conf import settings
+
+logger = logging.getLogger('media_library')
+
+# Redis channel used to tell every worker process that a site changed
+INVALIDATION_CHANNEL = 'media_library:html_site_invalidate'
+
+_MISSING = object()
+
+
+class _LRUCache:
+    """Thread-safe LRU mapping whose entries expire ``ttl`` seconds after being stored."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                return _MISSING
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return _MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def pop_media(self, media_id):
+        """Drop the entries keyed ``(media_id, ...)``."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == media_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class _ByteLRUCache:
+    """
+    Thread-safe LRU of ``(media_id, name) -> (etag, bytes)`` holding at most
+    ``max_bytes`` of data, where no single entry may exceed ``max_object_bytes``.
+    """
+
+    def __init__(self, max_bytes, max_object_bytes):
+        self.max_bytes = max_bytes
+        self.max_object_bytes = min(max_object_bytes, max_bytes)
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, etag):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != etag:
+                # Stored for an older version of the file
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, etag, data):
+        if len(data) > self.max_object_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (etag, data)
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= len(entry[1])
+
+    def pop_media(self, media_id):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == media_id]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+
+@dataclass
+class SiteRoute:
+    """What serve_html_site needs to know about a site"""
+    is_html: bool
+    html_base_dir: str
+    html_index_path: str
+    html_storage_mode: str
+    html_version: int
+    # Whether the site has a manifest (sites extracted before manifests didn't)
+    has_manifest: bool = False
+
+
+@dataclass(frozen=True)
+class SiteAsset:
+    """The manifest entry (HTMLSiteAsset) of one file, as served by serve_html_site"""
+    media_id: int
+    path: str
+    storage_key: str
+    offset: int | None
+    size: int
+    content_type: str
+    encoding: str
+    etag: str
+    variants: dict
+    stored_at: datetime
+
+
+SITE_ASSET_FIELDS = [f.name for f in fields(SiteAsset)]
+
+_routes = _LRUCache(settings.HTML_SITE_ROUTE_CACHE_SIZE, settings.HTML_SITE_ROUTE_CACHE_TTL)
+_site_assets = _LRUCache(settings.HTML_SITE_ASSET_INDEX_SIZE, settings.HTML_SITE_ROUTE_CACHE_TTL)
+_assets = _ByteLRUCache(settings.HTML_SITE_ASSET_CACHE_BYTES, settings.HTML_SITE_ASSET_CACHE_MAX_OBJECT)
+_listener_pid = None
+_listener_lock = threading.Lock()
+_client = None
+
+
+def redis_client():
+    """The process-wide Redis client (REDIS_URL)."""
+    global _client
+    if _client is None:
+        import redis
+
+        _client = redis.Redis.from_url(settings.REDIS_URL)
+    return _client
+
+
+def _listen():
+    """Drop routes other processes report as changed, for as long as this process lives."""
+    while True:
+        try:
+            pubsub = redis_client().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            for message in pubsub.listen():
+                _forget(int(message['data']))
+        except Exception as e:
+            logger.warning(f"HTML site cache invalidation listener failed: {e}")
+        # Messages may have been missed while disconnected
+        _routes.clear()
+        _site_assets.clear()
+        _assets.clear()
+        time.sleep(5)
+
+
+def _ensure_listener():
+    # Started lazily so forked workers each get their own thread
+    global _listener_pid
+    if _listener_pid == os.getpid() or not settings.REDIS_URL:
+        return
+    with _listener_lock:
+        if _listener_pid != os.getpid():
+            threading.Thread(target=_listen, name='html-site-cache', daemon=True).start()
+            _listener_pid = os.getpid()
+
+
+def _load_route(media_id):
+    from .models import MediaFile
+
+    media = (
+        MediaFile.objects.filter(pk=media_id)
+        .only('is_html', 'html_base_dir', 'html_index_path', 'html_storage_mode', 'html_version')
+        .first()
+    )
+    if media is None:
+        return None
+
+    return SiteRoute(
+        is_html=media.is_html,
+        html_base_dir=media.html_base_dir,
+        html_index_path=media.html_index_path,
+        html_storage_mode=media.html_storage_mode,
+        html_version=media.html_version,
+        has_manifest=media.is_html and media.html_assets.exists(),
+    )
+
+
+def get_site_route(media_id):
+    """
+    Return the SiteRoute of ``media_id`` (None if there is no such media).
+
+    Routes are kept per process for HTML_SITE_ROUTE_CACHE_TTL seconds, so the
+    assets of a page don't each look the site up again.
+    """
+    if not settings.HTML_SITE_ROUTE_CACHE_TTL:
+        return _load_route(media_id)
+
+    _ensure_listener()
+    route = _routes.get(media_id)
+    if route is _MISSING:
+        route = _load_route(media_id)
+        _routes.set(media_id, route)
+    return route
+
+
+def _load_asset(media_id, version, path):
+    from .models import HTMLSiteAsset
+
+    row = (
+        HTMLSiteAsset.objects.filter(media_id=media_id, version=version, path=path)
+        .values(*SITE_ASSET_FIELDS)
+        .first()
+    )
+    return SiteAsset(**row) if row else None
+
+
+def get_site_asset(media_id, version, path):
+    """
+    Return the SiteAsset stored for ``path`` by extraction ``version`` of site
+    ``media_id``, or None if that manifest has no such file.
+
+    Entries (misses included) are kept per process like routes, up to
+    HTML_SITE_ASSET_INDEX_SIZE of them, so a hot file costs no query and a
+    site's manifest is never loaded as a whole.
+    """
+    if not settings.HTML_SITE_ROUTE_CACHE_TTL:
+        return _load_asset(media_id, version, path)
+
+    _ensure_listener()
+    key = (media_id, version, path)
+    asset = _site_assets.get(key)
+    if asset is _MISSING:
+        asset = _load_asset(media_id, version, path)
+        _site_assets.set(key, asset)
+    return asset
+
+
+def _load_version_base_dir(media_id, version):
+    from django.db.models.functions import Length
+    from .models import HTMLSiteAsset
+
+    # The shallowest index.html, as picked when the version was extracted
+    index_path = (
+        HTMLSiteAsset.objects.filter(media_id=media_id, version=version, path__endswith='index.html')
+        .order_by(Length('path'), 'id')
+        .values_list('path', flat=True)
+        .first()
+    )
+    return os.path.dirname(index_path) if index_path else None
+
+
+def get_version_base_dir(media_id, version):
+    """
+    Return the directory extraction ``version`` of site ``media_id`` is served
+    from, or None if its manifest is gone. The live version's is the route's
+    html_base_dir; superseded ones are found from their manifest (each run
+    extracts under a prefix of its own) and cached like assets.
+    """
+    if not settings.HTML_SITE_ROUTE_CACHE_TTL:
+        return _load_version_base_dir(media_id, version)
+
+    _ensure_listener()
+    key = (media_id, version)
+    base_dir = _site_assets.get(key)
+    if base_dir is _MISSING:
+        base_dir = _load_version_base_dir(media_id, version)
+        _site_assets.set(key, base_dir)
+    return base_dir
+
+
+def cacheable_asset_size(size):
+    """Whether a body of ``size`` bytes may be kept in the hot-asset cache."""
+    return size <= _assets.max_object_bytes
+
+
+def get_cached_asset(media_id, name, etag):
+    """Return the cached bytes of storage name ``name`` if they are still ``etag``, else None."""
+    if not _assets.max_bytes:
+        return None
+    return _assets.get((media_id, name), etag)
+
+
+def cache_asset(media_id, name, etag, data):
+    """Keep the bytes of ``name`` in memory (HTML_SITE_ASSET_CACHE_BYTES per process)."""
+    if _assets.max_bytes:
+        _assets.set((media_id, name), etag, data)
+
+
+def _forget(media_id):
+    _routes.pop(media_id)
+    _site_assets.pop_media(media_id)
+    _assets.pop_media(media_id)
+
+
+def invalidate_site(media_id):
+    """Forget the cached route and assets of ``media_id`` here and in every other process."""
+    _forget(media_id)
+    if not settings.REDIS_URL:
+        return
+    try:
+        redis_client().publish(INVALIDATION_CHANNEL, media_id)
+    except Exception as e:
+        # Other processes catch up when their entry expires
+        logger.warning(f"Failed to publish cache invalidation for media {media_id}: {e}")
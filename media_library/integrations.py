@@ -1,6 +1,7 @@
 # media_library/integrations.py
 from django.urls import reverse
 from .models import MediaFile, MediaUsage
+from .renditions import VARIANT_AUTO, rendition_names, variant_url
 
 
 class MediaLibraryIntegration:
@@ -18,26 +19,40 @@ class MediaLibraryIntegration:
             return None
 
     @staticmethod
-    def get_media_url(media_id, size='original'):
+    def get_media_url(media_id, size='original', srcset=None):
         """
         Get URL for a media file with specified size
         size options: 'original', 'thumbnail', 'medium'
+
+        With ``srcset`` (widths in pixels, e.g. [480, 960, 1920]) a dictionary
+        is returned instead: {'src': <URL>, 'srcset': '<URL> 480w, ...'}, the
+        srcset listing resized copies of the image (empty for other files),
+        each served in the smallest format the browser accepts.
         """
         media = MediaLibraryIntegration.get_media_by_id(media_id)
         if not media:
             return None
 
         if size == 'thumbnail' and media.file_type == 'image':
-            return media.thumbnail.url
+            url = media.thumbnail_url
         elif size == 'medium' and media.file_type == 'image':
-            return media.medium.url
+            url = media.medium_url
         else:
-            return media.file.url
+            url = media.file.url
+
+        if srcset is None:
+            return url
+        widths = sorted(set(srcset)) if media.file_type == 'image' else []
+        return {
+            'src': url,
+            'srcset': ', '.join(f'{variant_url(media.id, media.file.name, width, fmt=VARIANT_AUTO)} {width}w' for width in widths),
+        }
 
     @staticmethod
     def get_media_for_template(media_id):
         """
         Returns a dictionary with all media details for use in templates
+        ('renditions' holds every stored format of each rendition, for <picture>)
         """
         media = MediaLibraryIntegration.get_media_by_id(media_id)
         if not media:
@@ -50,8 +65,14 @@ class MediaLibraryIntegration:
             'alt_text': media.alt_text,
             'description': media.description,
             'url': media.file.url,
-            'thumbnail_url': media.thumbnail.url if media.file_type == 'image' else None,
-            'medium_url': media.medium.url if media.file_type == 'image' else None,
+            'thumbnail_url': media.thumbnail_url if media.file_type == 'image' else None,
+            'medium_url': media.medium_url if media.file_type == 'image' else None,
+            'renditions': {
+                name: media.rendition_urls(name) for name in rendition_names(MediaFile)
+            } if media.file_type == 'image' else None,
+            'width': media.width,
+            'height': media.height,
+            'placeholder': media.placeholder,
         }
 
 
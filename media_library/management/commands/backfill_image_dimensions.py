@@ -0,0 +1,52 @@
+# media_library/management/commands/backfill_image_dimensions.py
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from media_library.models import MediaFile
+from media_library.renditions import image_dimensions
+from media_library.utils import open_media_file_seekable
+
+
+def read_dimensions(media):
+    # Ranged reads: only the first buffer of a remote image is fetched
+    with open_media_file_seekable(media, ranged=True) as f:
+        return image_dimensions(f)
+
+
+class Command(BaseCommand):
+    help = ('Reads the width/height of images saved before they were read at upload, '
+            'from the image headers (placeholders are rendered by render_image_renditions)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('ids', nargs='*', type=int,
+                            help='Only read these media IDs')
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Images read in parallel')
+
+    def handle(self, *args, **options):
+        queryset = MediaFile.objects.filter(file_type='image', width__isnull=True).only('id', 'file').order_by('id')
+        if options['ids']:
+            queryset = queryset.filter(id__in=options['ids'])
+
+        def read(media):
+            try:
+                return read_dimensions(media)
+            except Exception as e:
+                self.stderr.write(self.style.ERROR(f'Media {media.id}: {e}'))
+                return None
+
+        updated = failed = 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            media_files = list(queryset)
+            for media, dimensions in zip(media_files, executor.map(read, media_files)):
+                if dimensions is None:
+                    failed += 1
+                    continue
+                width, height = dimensions
+                MediaFile.objects.filter(pk=media.id).update(width=width, height=height)
+                updated += 1
+
+        if failed:
+            self.stderr.write(self.style.ERROR(f'{failed} image(s) could not be read'))
+        self.stdout.write(self.style.SUCCESS(f'Updated {updated} image(s)'))
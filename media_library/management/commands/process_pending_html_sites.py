@@ -0,0 +1,29 @@
+# media_library/management/commands/process_pending_html_sites.py
+from django.core.management.base import BaseCommand
+
+from media_library.models import MediaFile, ProcessingStatus
+from media_library.tasks import process_html_zip_file
+
+
+class Command(BaseCommand):
+    help = ('Queues processing for HTML sites that are pending without a message to process them '
+            '(e.g. uploads left unprocessed when processing_status was added)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('ids', nargs='*', type=int,
+                            help='Only queue these media IDs')
+
+    def handle(self, *args, **options):
+        queryset = MediaFile.objects.filter(
+            is_html=True, processing_status=ProcessingStatus.PENDING
+        ).order_by('id')
+        if options['ids']:
+            queryset = queryset.filter(id__in=options['ids'])
+
+        queued = 0
+        # Sites that do have a message queued are only processed once (see claim_processing)
+        for media_id in queryset.values_list('id', flat=True).iterator():
+            process_html_zip_file.send(media_id)
+            queued += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Queued {queued} HTML site(s)'))
@@ -0,0 +1,59 @@
+# media_library/management/commands/rebuild_html_sites.py
+from django.core.management.base import BaseCommand
+
+from media_library.models import MediaFile, ProcessingStatus
+from media_library.tasks import heartbeat, schedule_version_collection
+from media_library.utils import process_html_zip_file_now
+
+
+class Command(BaseCommand):
+    help = 'Re-extracts HTML sites so they get an asset manifest (by default only sites without one)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('ids', nargs='*', type=int,
+                            help='Only rebuild these media IDs')
+        parser.add_argument('--all', action='store_true',
+                            help='Rebuild sites that already have a manifest too')
+
+    def handle(self, *args, **options):
+        queryset = MediaFile.objects.filter(is_html=True).order_by('id')
+        if options['ids']:
+            queryset = queryset.filter(id__in=options['ids'])
+        if not options['all']:
+            queryset = queryset.filter(html_assets__isnull=True)
+
+        failed = skipped = 0
+        for media in queryset.iterator():
+            # Claimed like process_html_zip_file does, so a worker never extracts
+            # the same site at the same time
+            previous_status = media.processing_status
+            MediaFile.objects.filter(pk=media.id).exclude(
+                processing_status=ProcessingStatus.PROCESSING
+            ).update(processing_status=ProcessingStatus.PENDING)
+            claimed = MediaFile.claim_processing(media.id)
+            if claimed is None:
+                skipped += 1
+                self.stderr.write(self.style.WARNING(f'Media {media.id}: being processed by a worker, skipped'))
+                continue
+
+            media = claimed
+            try:
+                with heartbeat(media.id, media.processing_claim):
+                    media = process_html_zip_file_now(media)
+            except Exception as e:
+                failed += 1
+                # Hand the site back as it was, unless a worker has taken it over
+                MediaFile.objects.filter(
+                    pk=media.id, processing_status=ProcessingStatus.PROCESSING, processing_claim=media.processing_claim
+                ).update(processing_status=previous_status)
+                self.stderr.write(self.style.ERROR(f'Media {media.id}: {e}'))
+                continue
+
+            # process_html_zip_file_now has saved the outcome
+            schedule_version_collection(media)
+            self.stdout.write(f'Rebuilt media {media.id}: {media.html_index_path}')
+
+        if failed or skipped:
+            self.stderr.write(self.style.ERROR(f'{failed} site(s) failed to rebuild, {skipped} skipped'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Done'))
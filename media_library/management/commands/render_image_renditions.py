@@ -0,0 +1,29 @@
+# media_library/management/commands/render_image_renditions.py
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from media_library.models import MediaFile
+from media_library.tasks import generate_renditions
+
+
+class Command(BaseCommand):
+    help = ('Queues rendition rendering for images whose renditions or placeholder are missing '
+            '(e.g. uploaded before they were rendered eagerly)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('ids', nargs='*', type=int,
+                            help='Only render these media IDs')
+
+    def handle(self, *args, **options):
+        queryset = MediaFile.objects.filter(
+            Q(renditions_ready=False) | Q(placeholder=''), file_type='image'
+        ).order_by('id')
+        if options['ids']:
+            queryset = queryset.filter(id__in=options['ids'])
+
+        queued = 0
+        for media_id in queryset.values_list('id', flat=True).iterator():
+            generate_renditions.send(media_id)
+            queued += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Queued {queued} image(s)'))
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.6 on 2026-10-18 19:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media_library', '0003_alter_mediafile_options'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mediafile',
+            name='html_storage_mode',
+            field=models.CharField(choices=[('files', 'Files'), ('blobs', 'Blobs')], default='files', editable=False, max_length=10),
+        ),
+        migrations.CreateModel(
+            name='HTMLSiteAsset',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(help_text='Storage path the file is served as (under html_base_dir)', max_length=512)),
+                ('storage_key', models.CharField(db_index=True, help_text='Storage path of the stored bytes', max_length=512)),
+                ('sha256', models.CharField(max_length=64)),
+                ('size', models.BigIntegerField()),
+                ('media', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='html_assets', to='media_library.mediafile')),
+            ],
+            options={
+                'verbose_name': 'HTML Site Asset',
+                'verbose_name_plural': 'HTML Site Assets',
+                'unique_together': {('media', 'path')},
+            },
+        ),
+    ]
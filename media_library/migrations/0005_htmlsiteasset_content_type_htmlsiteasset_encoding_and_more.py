@@ -0,0 +1,57 @@
+# Generated by Django 5.1.6 on 2026-10-18 19:26
+
+import mimetypes
+import os
+
+from django.db import migrations, models
+
+# A copy of utils.CONTENT_TYPE_OVERRIDES as of this migration, so later changes
+# to utils don't change what it does
+CONTENT_TYPE_OVERRIDES = {
+    '.js': 'application/javascript',
+    '.wasm': 'application/wasm',
+    '.gltf': 'model/gltf+json',
+    '.css': 'text/css',
+}
+
+
+def guess_content_type(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in CONTENT_TYPE_OVERRIDES:
+        return CONTENT_TYPE_OVERRIDES[ext]
+    content_type, _ = mimetypes.guess_type(path)
+    return content_type or 'application/octet-stream'
+
+
+def fill_manifest_headers(apps, schema_editor):
+    HTMLSiteAsset = apps.get_model('media_library', 'HTMLSiteAsset')
+    for asset in HTMLSiteAsset.objects.all().iterator():
+        asset.content_type = guess_content_type(asset.path)
+        asset.etag = f'"{asset.sha256}"'
+        asset.save(update_fields=['content_type', 'etag'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media_library', '0004_mediafile_html_storage_mode_htmlsiteasset'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='htmlsiteasset',
+            name='content_type',
+            field=models.CharField(default='application/octet-stream', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='htmlsiteasset',
+            name='encoding',
+            field=models.CharField(blank=True, help_text='Content-Encoding of the stored bytes, if any', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='htmlsiteasset',
+            name='etag',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.RunPython(fill_manifest_headers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 19:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media_library', '0005_htmlsiteasset_content_type_htmlsiteasset_encoding_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='htmlsiteasset',
+            name='variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.1.6 on 2026-10-18 19:40
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media_library', '0006_htmlsiteasset_variants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='htmlsiteasset',
+            name='stored_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.6 on 2026-10-18 19:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media_library', '0007_htmlsiteasset_stored_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='htmlsiteasset',
+            name='offset',
+            field=models.BigIntegerField(blank=True, help_text='Where the bytes start inside storage_key, for members of a site zip', null=True),
+        ),
+        migrations.AlterField(
+            model_name='mediafile',
+            name='html_storage_mode',
+            field=models.CharField(choices=[('files', 'Files'), ('blobs', 'Blobs'), ('zip', 'Zip')], default='files', editable=False, max_length=10),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.6 on 2026-10-18 19:46
+
+from django.db import migrations, models
+
+
+def fill_processing_status(apps, schema_editor):
+    MediaFile = apps.get_model('media_library', 'MediaFile')
+    MediaFile.objects.filter(is_html=False).update(processing_status='ready')
+    html = MediaFile.objects.filter(is_html=True)
+    html.exclude(html_index_path='').update(processing_status='ready')
+    html.filter(html_index_path='').exclude(processing_error='').update(processing_status='failed')
+    # The rest stay pending, but no message is queued for them: run
+    # `manage.py process_pending_html_sites` after migrating
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media_library', '0008_htmlsiteasset_offset'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mediafile',
+            name='processing_heartbeat_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='mediafile',
+            name='processing_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('ready', 'Ready'), ('failed', 'Failed')], default='pending', editable=False, max_length=20),
+        ),
+        migrations.RunPython(fill_processing_status, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 19:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media_library', '0009_mediafile_processing_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mediafile',
+            name='html_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 20:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media_library', '0010_mediafile_html_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mediafile',
+            name='renditions_ready',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
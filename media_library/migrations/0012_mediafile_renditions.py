@@ -0,0 +1,26 @@
+# Generated by Django 5.1.6 on 2026-10-18 20:10
+
+from django.db import migrations, models
+
+
+def forget_ready_renditions(apps, schema_editor):
+    # Their names aren't recorded yet; render_image_renditions records them
+    # (without re-rendering files that exist)
+    MediaFile = apps.get_model('media_library', 'MediaFile')
+    MediaFile.objects.filter(renditions_ready=True).update(renditions_ready=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media_library', '0011_mediafile_renditions_ready'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mediafile',
+            name='renditions',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+        migrations.RunPython(forget_ready_renditions, migrations.RunPython.noop),
+    ]
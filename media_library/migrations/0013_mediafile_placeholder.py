@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 20:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media_library', '0012_mediafile_renditions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mediafile',
+            name='placeholder',
+            field=models.TextField(blank=True, editable=False),
+        ),
+    ]
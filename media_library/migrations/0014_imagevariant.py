@@ -0,0 +1,35 @@
+# Generated by Django 5.1.6 on 2026-10-18 20:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media_library', '0013_mediafile_placeholder'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageVariant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(help_text='Name of the media file it was rendered from', max_length=255)),
+                ('width', models.PositiveIntegerField()),
+                ('height', models.PositiveIntegerField()),
+                ('fit', models.CharField(max_length=10)),
+                ('format', models.CharField(max_length=10)),
+                ('storage_key', models.CharField(help_text='Storage path of the rendered image', max_length=512)),
+                ('size', models.BigIntegerField()),
+                ('etag', models.CharField(max_length=100)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('media', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='image_variants', to='media_library.mediafile')),
+            ],
+            options={
+                'verbose_name': 'Image Variant',
+                'verbose_name_plural': 'Image Variants',
+                'unique_together': {('media', 'source', 'width', 'height', 'fit', 'format')},
+            },
+        ),
+    ]
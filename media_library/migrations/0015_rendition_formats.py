@@ -0,0 +1,21 @@
+# Generated by Django 5.1.6 on 2026-10-18 21:02
+
+from django.db import migrations
+
+
+def forget_ready_renditions(apps, schema_editor):
+    # Their renditions are only recorded as JPEG; render_image_renditions adds
+    # the other formats (without re-rendering files that exist)
+    MediaFile = apps.get_model('media_library', 'MediaFile')
+    MediaFile.objects.filter(renditions_ready=True).update(renditions_ready=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media_library', '0014_imagevariant'),
+    ]
+
+    operations = [
+        migrations.RunPython(forget_ready_renditions, migrations.RunPython.noop),
+    ]
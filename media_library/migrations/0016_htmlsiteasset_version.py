@@ -0,0 +1,37 @@
+# Generated by Django 5.1.6 on 2026-10-18 20:28
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def fill_asset_version(apps, schema_editor):
+    # Existing manifests are those of the version each site serves
+    HTMLSiteAsset = apps.get_model('media_library', 'HTMLSiteAsset')
+    MediaFile = apps.get_model('media_library', 'MediaFile')
+    HTMLSiteAsset.objects.update(
+        version=Subquery(MediaFile.objects.filter(pk=OuterRef('media_id')).values('html_version')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media_library', '0015_rendition_formats'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='htmlsiteasset',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='htmlsiteasset',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_asset_version, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='htmlsiteasset',
+            unique_together={('media', 'version', 'path')},
+        ),
+    ]
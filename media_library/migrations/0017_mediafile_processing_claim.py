@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 20:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('media_library', '0016_htmlsiteasset_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mediafile',
+            name='processing_claim',
+            field=models.CharField(blank=True, editable=False, max_length=32),
+        ),
+    ]
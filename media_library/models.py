@@ -1,20 +1,26 @@
 # media_library/models.py
 import os
+import re
 import shutil
+import uuid
 import zipfile
+from datetime import timedelta
 
 from django.conf import settings
 from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.auth.models import AbstractUser, PermissionsMixin
-from django.db import models
+from django.db import models, transaction
+from django.db.models import DEFERRED, Q
 from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
+from django.templatetags.static import static
+from django.urls import reverse
 from django.utils.text import slugify
 from django.utils import timezone
 from imagekit.models import ImageSpecField
 from imagekit.processors import ResizeToFill
 
-from media_library.utils import process_html_zip_file_now
+from .renditions import NEGOTIATED_FORMATS, image_dimensions
 
 
 def upload_to(instance, filename):
@@ -109,6 +115,24 @@ class MediaUsage(models.Model):
         return f"{self.media.title} used in {self.content_type} ({self.field_name})"
 
 
+class HTMLStorageMode(models.TextChoices):
+    """How the files of an extracted HTML site are laid out in storage"""
+    # One object per member under html_sites/{id}/v{version}/, addressable by path
+    FILES = 'files', 'Files'
+    # Content-addressed objects under html_blobs/, shared between sites
+    BLOBS = 'blobs', 'Blobs'
+    # A single store-only zip under html_sites/{id}/v{version}/, members read by byte range
+    ZIP = 'zip', 'Zip'
+
+
+class ProcessingStatus(models.TextChoices):
+    """Where an HTML site is in its extraction (other media are always ready)"""
+    PENDING = 'pending', 'Pending'
+    PROCESSING = 'processing', 'Processing'
+    READY = 'ready', 'Ready'
+    FAILED = 'failed', 'Failed'
+
+
 class MediaFile(models.Model):
     title = models.CharField(max_length=255, blank=True)
     file = models.FileField(upload_to=upload_to)
@@ -122,8 +146,22 @@ class MediaFile(models.Model):
     html_index_path = models.CharField(max_length=255, blank=True, editable=False)
     html_base_dir = models.CharField(max_length=255, blank=True, editable=False)
     original_zip_path = models.CharField(max_length=255, blank=True, editable=False)
+    html_storage_mode = models.CharField(
+        max_length=10, choices=HTMLStorageMode.choices, default=HTMLStorageMode.FILES, editable=False
+    )
+    # Every extraction is stored under a new html_sites/{id}/v{version}-{token}/ prefix
+    # (token: a hash of the ZIP's name) and served under /v{version}/; 0 for sites
+    # extracted before versions existed, which live directly under html_sites/{id}/
+    html_version = models.PositiveIntegerField(default=0, editable=False)
 
     # Processing status
+    processing_status = models.CharField(
+        max_length=20, choices=ProcessingStatus.choices, default=ProcessingStatus.PENDING, editable=False
+    )
+    # Renewed while a worker processes the media; a stale heartbeat means the worker died
+    processing_heartbeat_at = models.DateTimeField(null=True, blank=True, editable=False)
+    # Set anew by every claim, so the messages of a claim that was taken over can tell
+    processing_claim = models.CharField(max_length=32, blank=True, editable=False)
     is_processed = models.BooleanField(default=False, editable=False)
     processing_error = models.TextField(blank=True, editable=False)
 
@@ -132,8 +170,17 @@ class MediaFile(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
 
     # Image specific fields (will be null for non-image files)
+    # Read from the image header when the file is saved
     width = models.IntegerField(null=True, editable=False)
     height = models.IntegerField(null=True, editable=False)
+    # A tiny blurry version of the image (data: URI), shown while it loads
+    placeholder = models.TextField(blank=True, editable=False)
+    # Set once tasks.generate_renditions has stored every rendition of the current file
+    renditions_ready = models.BooleanField(default=False, editable=False)
+    # Storage names and sizes of those renditions, in each format they are stored
+    # in ({'thumbnail': {'jpg': {'name': ..., 'size': ...}, 'webp': ...}, ...}),
+    # so their URLs are built without imagekit or a storage round-trip
+    renditions = models.JSONField(default=dict, blank=True, editable=False)
 
     # Thumbnails for images
     thumbnail = ImageSpecField(
@@ -150,14 +197,145 @@ class MediaFile(models.Model):
         options={'quality': 85}
     )
 
+    # Fields written when an HTML site finishes processing
+    PROCESSING_RESULT_FIELDS = [
+        'html_index_path', 'original_zip_path', 'html_base_dir', 'html_storage_mode', 'html_version',
+        'processing_status', 'processing_error', 'is_processed',
+    ]
+
     class Meta:
         ordering = ['-uploaded_at']
 
     def __str__(self):
         return self.title
 
+    def rendition_url(self, name):
+        """
+        URL of rendition ``name`` ('thumbnail', 'medium') in its spec's own format
+        (JPEG, which every client decodes), or of a placeholder until it has been
+        rendered; renditions are never rendered inside a request.
+        """
+        formats = self.renditions.get(name) if self.renditions_ready else None
+        if not formats:
+            return static(settings.IMAGE_RENDITION_PLACEHOLDER)
+        fmt = next(fmt for fmt in formats if fmt not in NEGOTIATED_FORMATS.values())
+        return self.file.storage.url(formats[fmt]['name'])
+
+    def rendition_urls(self, name):
+        """
+        URLs of every stored format of rendition ``name``, by extension, smallest
+        first; empty until it has been rendered. Pages and API clients pick the
+        format (e.g. with <picture>), since only the image request's Accept
+        header says what the client decodes.
+        """
+        formats = self.renditions.get(name) if self.renditions_ready else None
+        return {
+            fmt: self.file.storage.url(stored['name'])
+            for fmt, stored in sorted((formats or {}).items(), key=lambda item: item[1]['size'])
+        }
+
+    @property
+    def thumbnail_url(self):
+        return self.rendition_url('thumbnail')
+
+    @property
+    def medium_url(self):
+        return self.rendition_url('medium')
+
+    def _read_dimensions(self):
+        if self.file_type != 'image':
+            return None
+        if not self.file._committed:
+            # A new upload, still in memory or a local temporary file
+            return image_dimensions(self.file.file)
+
+        # Already in storage (e.g. saved with FieldFile.save()): ranged reads, so
+        # only the header of a remote image is fetched
+        from .utils import open_media_file_seekable
+
+        try:
+            with open_media_file_seekable(self, ranged=True) as f:
+                return image_dimensions(f)
+        except Exception:
+            # Left for backfill_image_dimensions rather than failing the save
+            return None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remembered so save() can tell when a new ZIP replaces the old one
+        instance._loaded_file_name = instance.__dict__.get('file', DEFERRED)
+        return instance
+
+    @classmethod
+    def claim_processing(cls, media_id):
+        """
+        Mark a pending HTML site as processing and return it, or None if it isn't
+        this caller's to process.
+
+        The update is atomic, so of several workers holding a message for the same
+        media exactly one wins. A claim whose heartbeat is older than
+        HTML_SITE_PROCESSING_LEASE belongs to a worker that died and may be taken over.
+        The returned media's processing_claim identifies this claim.
+        """
+        now = timezone.now()
+        abandoned = now - timedelta(seconds=settings.HTML_SITE_PROCESSING_LEASE)
+        claimed = cls.objects.filter(pk=media_id, is_html=True).filter(
+            Q(processing_status=ProcessingStatus.PENDING)
+            | Q(processing_status=ProcessingStatus.PROCESSING, processing_heartbeat_at__lt=abandoned)
+        ).update(
+            processing_status=ProcessingStatus.PROCESSING, processing_heartbeat_at=now, processing_claim=uuid.uuid4().hex
+        )
+        return cls.objects.get(pk=media_id) if claimed else None
+
+    def save_processing_result(self, from_version):
+        """
+        Save PROCESSING_RESULT_FIELDS and return True, unless the ZIP was replaced
+        or another run finished the site since processing started at html_version
+        ``from_version``.
+
+        The row stays locked until the caller's transaction commits, so whatever is
+        written with the result (the manifest) can't interleave with another run's.
+        """
+        with transaction.atomic():
+            current = MediaFile.objects.select_for_update().filter(
+                pk=self.pk, file=self.file.name, html_version=from_version
+            )
+            if not current.exists():
+                return False
+            self.save(update_fields=self.PROCESSING_RESULT_FIELDS)
+        return True
+
+    @classmethod
+    def renew_processing(cls, media_id, claim):
+        """Push back the expiry of processing claim ``claim``; returns False if it isn't held any more."""
+        return bool(
+            cls.objects.filter(
+                pk=media_id, processing_status=ProcessingStatus.PROCESSING, processing_claim=claim
+            ).update(processing_heartbeat_at=timezone.now())
+        )
+
+    @property
+    def html_site_url(self):
+        """
+        URL an HTML site is embedded by: its serve_html_site URL, which stays the
+        same across re-uploads, or for a site extracted by path before versions
+        existed, its index.html in storage.
+        """
+        if self.html_storage_mode == HTMLStorageMode.FILES and not self.html_version and self.html_index_path:
+            return f'{settings.MEDIA_URL}{self.html_index_path}'
+        return reverse('media_library:serve_html_site', kwargs={'media_id': self.id})
+
     @classmethod
     def get_media_by_url(cls, media_url):
+        # HTML sites are referenced by their serve URL
+        match = re.search(r'html-site/(\d+)/', media_url)
+        if match:
+            return cls.objects.get(pk=match.group(1))
+        # or, if embedded before that, by the index.html of a version in storage
+        match = re.search(r'html_sites/(\d+)/v\d+-', media_url)
+        if match:
+            return cls.objects.get(pk=match.group(1))
         if media_url.endswith('.html'):
             return cls.objects.get(html_index_path=media_url)
         return cls.objects.get(file=media_url)
@@ -193,8 +371,88 @@ class MediaFile(models.Model):
             else:
                 self.file_type = 'other'
 
+        file_changed = self.file and (
+            self._state.adding or getattr(self, '_loaded_file_name', DEFERRED) not in (DEFERRED, self.file.name)
+        )
+        reset_fields = set()
+        if file_changed:
+            # Renditions of the new file are rendered in the background once this
+            # save commits (see signals.trigger_rendition_generation)
+            self.renditions_ready = False
+            self.renditions = {}
+            self.placeholder = ''
+            self.width, self.height = self._read_dimensions() or (None, None)
+            reset_fields |= {'renditions_ready', 'renditions', 'placeholder', 'width', 'height'}
+
+        if not self.is_html:
+            self.processing_status = ProcessingStatus.READY
+        elif file_changed:
+            # New or replaced ZIP: extracted in the background once this save commits
+            # (see signals.trigger_media_processing). The live version's paths stay
+            # until save_processing_result swaps the new one in, so it keeps serving
+            self.processing_status = ProcessingStatus.PENDING
+            self.is_processed = False
+            self.processing_error = ''
+            reset_fields |= {'processing_status', 'is_processed', 'processing_error'}
+
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and reset_fields:
+            kwargs['update_fields'] = set(update_fields) | reset_fields
+
+        # Read by signals.trigger_rendition_generation
+        self._file_changed = bool(file_changed)
         super().save(*args, **kwargs)
+        self._loaded_file_name = self.file.name if self.file else None
+
+
+class HTMLSiteAsset(models.Model):
+    """Manifest entry mapping one file of an extracted HTML site to the object holding its bytes"""
+    media = models.ForeignKey(MediaFile, on_delete=models.CASCADE, related_name='html_assets')
+    # The extraction (MediaFile.html_version) it belongs to; superseded versions keep
+    # their manifest until tasks.collect_html_site_versions deletes them
+    version = models.PositiveIntegerField(default=0)
+    path = models.CharField(max_length=512, help_text="Storage path the file is served as (under html_base_dir)")
+    storage_key = models.CharField(max_length=512, db_index=True, help_text="Storage path of the stored bytes")
+    offset = models.BigIntegerField(
+        null=True, blank=True, help_text="Where the bytes start inside storage_key, for members of a site zip"
+    )
+    sha256 = models.CharField(max_length=64)
+    size = models.BigIntegerField()
+    content_type = models.CharField(max_length=100, default='application/octet-stream')
+    encoding = models.CharField(max_length=20, blank=True, help_text="Content-Encoding of the stored bytes, if any")
+    etag = models.CharField(max_length=100, blank=True)
+    # Precompressed copies, e.g. {"br": {"storage_key": "....js.br", "size": 1234}}
+    # (zip mode variants are members of the same zip and carry an "offset" too)
+    variants = models.JSONField(default=dict, blank=True)
+    # Rows are rewritten on every extraction, so this is the Last-Modified of the file
+    stored_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "HTML Site Asset"
+        verbose_name_plural = "HTML Site Assets"
+        unique_together = ('media', 'version', 'path')
 
-        media = process_html_zip_file_now(self)
-        if media:
-            media.save(update_fields=['html_index_path', 'original_zip_path', 'html_base_dir'])
+    def __str__(self):
+        return self.path
+
+
+class ImageVariant(models.Model):
+    """A resized copy of an image, rendered on demand by views.serve_image_variant"""
+    media = models.ForeignKey(MediaFile, on_delete=models.CASCADE, related_name='image_variants')
+    source = models.CharField(max_length=255, help_text="Name of the media file it was rendered from")
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    fit = models.CharField(max_length=10)
+    format = models.CharField(max_length=10)
+    storage_key = models.CharField(max_length=512, help_text="Storage path of the rendered image")
+    size = models.BigIntegerField()
+    etag = models.CharField(max_length=100)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Image Variant"
+        verbose_name_plural = "Image Variants"
+        unique_together = ('media', 'source', 'width', 'height', 'fit', 'format')
+
+    def __str__(self):
+        return self.storage_key
@@ -0,0 +1,162 @@
+# media_library/progress.py
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from .cache import redis_client
+
+logger = logging.getLogger('media_library')
+
+# Phases an extraction goes through, in order
+PHASE_DOWNLOADING = 'downloading'
+PHASE_EXTRACTING = 'extracting'
+PHASE_FINALIZING = 'finalizing'
+
+# Fields of the progress hash holding counters
+COUNTERS = ('members_done', 'members_total', 'bytes_done', 'bytes_total')
+
+# How long progress is kept once nothing reports it any more
+PROGRESS_TTL = 24 * 60 * 60
+
+
+def progress_key(media_id):
+    """Redis hash holding the extraction progress of ``media_id``; also the channel updates go to."""
+    return f'media_library:html_progress:{media_id}'
+
+
+# Without an update for this long, watch_progress yields None (for keep-alives)
+WATCH_KEEPALIVE = 15
+
+
+def _decode(stored):
+    progress = {field.decode(): value.decode() for field, value in stored.items()}
+    for field in COUNTERS:
+        progress[field] = int(progress.get(field, 0))
+    if 'updated_at' in progress:
+        progress['updated_at'] = float(progress['updated_at'])
+    return progress
+
+
+def get_progress(media_id):
+    """The last reported extraction progress of ``media_id``, or None if there is none."""
+    if not settings.REDIS_URL:
+        return None
+    try:
+        stored = redis_client().hgetall(progress_key(media_id))
+    except Exception as e:
+        logger.warning(f"Failed to read extraction progress of media {media_id}: {e}")
+        return None
+    return _decode(stored) if stored else None
+
+
+def clear_progress(media_id):
+    """Forget the progress of ``media_id``; a new upload starts over."""
+    if not settings.REDIS_URL:
+        return
+    try:
+        redis_client().delete(progress_key(media_id))
+    except Exception as e:
+        logger.warning(f"Failed to clear extraction progress of media {media_id}: {e}")
+
+
+def watch_progress(media_id, timeout):
+    """
+    Yield the current progress of ``media_id`` (None if there is none) and then
+    every update published for it, for up to ``timeout`` seconds. After
+    WATCH_KEEPALIVE seconds without an update None is yielded.
+    """
+    pubsub = redis_client().pubsub(ignore_subscribe_messages=True)
+    try:
+        # Subscribed before the current state is read, so no update falls in between
+        pubsub.subscribe(progress_key(media_id))
+        yield get_progress(media_id)
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            message = pubsub.get_message(timeout=min(remaining, WATCH_KEEPALIVE))
+            yield json.loads(message['data']) if message else None
+    finally:
+        pubsub.close()
+
+
+class ExtractionProgress:
+    """
+    Reports how far the extraction of an HTML site is to a Redis hash, and
+    publishes every change on a channel of the same name.
+
+    Finished members are counted locally and added to the hash at most every
+    HTML_SITE_PROGRESS_INTERVAL_MS, with HINCRBY so that the shards of a sharded
+    extraction add up. Reporting is best effort: without Redis it does nothing.
+    """
+
+    def __init__(self, media_id):
+        self.media_id = media_id
+        self.key = progress_key(media_id)
+        self._enabled = bool(settings.REDIS_URL)
+        self._members = 0
+        self._bytes = 0
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _write(self, mapping=None, members=0, size=0):
+        if not self._enabled:
+            return
+        try:
+            with redis_client().pipeline() as pipe:
+                if mapping:
+                    pipe.hset(self.key, mapping={**mapping, 'updated_at': time.time()})
+                else:
+                    pipe.hset(self.key, 'updated_at', time.time())
+                if members:
+                    pipe.hincrby(self.key, 'members_done', members)
+                if size:
+                    pipe.hincrby(self.key, 'bytes_done', size)
+                pipe.expire(self.key, PROGRESS_TTL)
+                pipe.hgetall(self.key)
+                stored = pipe.execute()[-1]
+            redis_client().publish(self.key, json.dumps(_decode(stored)))
+        except Exception as e:
+            logger.warning(f"Extraction progress of media {self.media_id} unavailable: {e}")
+            self._enabled = False
+
+    def start(self, members_total, bytes_total, members_done=0, bytes_done=0):
+        """Begin the extracting phase, with ``members_done``/``bytes_done`` of it already stored."""
+        with self._lock:
+            self._members = self._bytes = 0
+        self._write({
+            'status': 'processing',
+            'phase': PHASE_EXTRACTING,
+            'error': '',
+            'members_total': members_total,
+            'bytes_total': bytes_total,
+            'members_done': members_done,
+            'bytes_done': bytes_done,
+        })
+
+    def phase(self, phase):
+        self.flush()
+        self._write({'status': 'processing', 'phase': phase})
+
+    def advance(self, size):
+        """Count one member of ``size`` bytes as done; reported once the interval has passed."""
+        with self._lock:
+            self._members += 1
+            self._bytes += size
+            if time.monotonic() - self._flushed_at < settings.HTML_SITE_PROGRESS_INTERVAL_MS / 1000:
+                return
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            members, size = self._members, self._bytes
+            self._members = self._bytes = 0
+            self._flushed_at = time.monotonic()
+        if members or size:
+            self._write(members=members, size=size)
+
+    def set_status(self, status, error=''):
+        """Record how processing ended (or that it will be retried)."""
+        self.flush()
+        self._write({'status': status, 'error': error})
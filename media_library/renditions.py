@@ -0,0 +1,358 @@
+# media_library/renditions.py
+import base64
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.signing import Signer
+from django.db import IntegrityError
+from django.urls import reverse
+from imagekit.models.fields.utils import ImageSpecFileDescriptor
+from PIL import Image, ImageOps
+from pilkit.processors import ProcessorPipeline, ResizeToFill, ResizeToFit, Transpose
+from pilkit.utils import img_to_fobj, open_image, process_image
+
+from .storage import delete_names
+
+try:
+    import pillow_avif  # noqa: F401 (adds AVIF to Pillow versions without it)
+except ImportError:  # AVIF is optional, only produced where Pillow can write it
+    pillow_avif = None
+
+logger = logging.getLogger('media_library')
+
+Image.init()
+AVIF_SUPPORTED = 'AVIF' in Image.SAVE
+
+# Formats every rendition is also stored in, besides its spec's own (JPEG),
+# by extension; pages offer them with <picture> (see media_tags.rendition_sources)
+RENDITION_FORMATS = {'webp': ('WEBP', {'quality': 80})}
+if AVIF_SUPPORTED:
+    RENDITION_FORMATS['avif'] = ('AVIF', {'quality': 60})
+
+# Formats not every client decodes, by content type
+NEGOTIATED_FORMATS = {'image/webp': 'webp', 'image/avif': 'avif'}
+
+# Longest side, in pixels, of the inline placeholder stored with each image
+PLACEHOLDER_SIZE = 16
+
+# EXIF orientations that rotate the image by 90 degrees, swapping width and height
+_TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+# Image variants (views.serve_image_variant): how the image is fitted into the
+# requested box, and the formats they are encoded as ("auto" picks one by Accept)
+VARIANT_FITS = ('fill', 'fit')
+VARIANT_FORMATS = {
+    'jpg': ('JPEG', 'image/jpeg', {'quality': 85}),
+    'png': ('PNG', 'image/png', {}),
+    'webp': ('WEBP', 'image/webp', {'quality': 80}),
+}
+if AVIF_SUPPORTED:
+    VARIANT_FORMATS['avif'] = ('AVIF', 'image/avif', {'quality': 60})
+VARIANT_AUTO = 'auto'
+VARIANT_PREFIX = 'image_variants'
+
+_variant_signer = Signer(salt='media_library.image_variant')
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+class Deferred:
+    """
+    imagekit cache file strategy that never renders inside a request.
+
+    Renditions are rendered by tasks.generate_renditions when an image is
+    uploaded; until then views show a placeholder (see MediaFile.rendition_url),
+    and asking for a rendition's URL costs no storage calls.
+    """
+
+    def should_verify_existence(self, file):
+        return False
+
+
+def rendition_names(model):
+    """Names of the ImageSpecFields (renditions) declared on ``model``."""
+    return [
+        name for name, attr in vars(model).items()
+        if isinstance(attr, ImageSpecFileDescriptor)
+    ]
+
+
+def accepted_formats(accept):
+    """
+    Extensions of the NEGOTIATED_FORMATS that ``accept`` (an Accept header)
+    lists by name. Wildcards don't count: clients send them for formats they
+    can't decode too.
+    """
+    accepted = set()
+    for item in (accept or '').split(','):
+        media_type, *params = item.split(';')
+        fmt = NEGOTIATED_FORMATS.get(media_type.strip().lower())
+        if fmt is None:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    pass
+        if quality > 0:
+            accepted.add(fmt)
+    return accepted
+
+
+def image_dimensions(file):
+    """
+    ``(width, height)`` of the image in ``file``, as displayed (EXIF orientation
+    applied), or None if it isn't a readable image.
+
+    Only the header is parsed; the pixels are never decoded. ``file`` is left at
+    the position it was read from.
+    """
+    position = file.tell()
+    try:
+        with Image.open(file) as img:
+            width, height = img.size
+            if img.getexif().get(0x0112) in _TRANSPOSED_ORIENTATIONS:
+                width, height = height, width
+            return width, height
+    except Exception:
+        return None
+    finally:
+        file.seek(position)
+
+
+def _placeholder(img):
+    """
+    A tiny blurry WebP of ``img`` as a data: URI, to show while the image loads;
+    EXIF orientation applied, so it has the shape image_dimensions reports.
+    """
+    small = ImageOps.exif_transpose(img)
+    small.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+    output = io.BytesIO()
+    small.convert('RGB').save(output, 'WEBP', quality=50)
+    return 'data:image/webp;base64,' + base64.b64encode(output.getvalue()).decode()
+
+
+def _render(source, specs):
+    """
+    Render each ``(processors, encodings)`` spec of the image ``source`` (bytes),
+    encoded once per ``(format, autoconvert, options)`` of ``encodings``, and
+    return the encoded results followed by the image's placeholder. Runs in the
+    rendition process pool, so the image is decoded once, and resized once per
+    spec, for everything.
+    """
+    img = open_image(io.BytesIO(source))
+    img.load()
+    rendered = []
+    for processors, encodings in specs:
+        copy = img.copy()
+        copy.format = img.format
+        processed = ProcessorPipeline(processors).process(copy)
+        rendered.append([
+            img_to_fobj(processed, format, autoconvert, **options).getvalue()
+            for format, autoconvert, options in encodings
+        ])
+    return rendered, _placeholder(img)
+
+
+def _executor():
+    # One pool per worker process; a forked child must not reuse its parent's.
+    # Its processes come from a forkserver rather than forking the worker, whose
+    # threads (heartbeats, cache listener, DB connections) must not be copied
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(
+                max_workers=settings.IMAGE_RENDITION_PROCESSES,
+                mp_context=multiprocessing.get_context('forkserver'),
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _reset_executor(pool):
+    """Drop ``pool`` if it is still the current one, so the next _executor() starts a new pool."""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is pool:
+            _pool, _pool_pid = None, None
+    pool.shutdown(wait=False)
+
+
+def render_renditions(media):
+    """
+    Render every rendition of image ``media`` that isn't stored yet, in the
+    rendition process pool. The spec's own format is stored where imagekit
+    expects it, and each of RENDITION_FORMATS next to it.
+
+    Returns the stored formats of every rendition, by rendition name, as
+    ``{name: {extension: {'name': ..., 'size': ...}}}``, and the image's
+    placeholder (rendered too if ``media`` has none).
+    """
+    stored = {}
+    specs, missing = [], []
+    for name in rendition_names(type(media)):
+        file = getattr(media, name)
+        generator = file.generator
+        base, extension = os.path.splitext(file.name)
+        encodings = {extension[1:].lower(): (file.name, generator.format, generator.autoconvert, generator.options)}
+        for fmt, (format, options) in RENDITION_FORMATS.items():
+            encodings[fmt] = (f'{base}.{fmt}', format, True, options)
+
+        stored[name] = {}
+        todo = []
+        for fmt, (stored_name, format, autoconvert, options) in encodings.items():
+            if file.storage.exists(stored_name):
+                stored[name][fmt] = {'name': stored_name, 'size': file.storage.size(stored_name)}
+            else:
+                todo.append((fmt, stored_name, format, autoconvert, options))
+        if todo:
+            specs.append((generator.processors, [encoding for _, _, *encoding in todo]))
+            missing.append((name, file.storage, todo))
+
+    if not specs and media.placeholder:
+        return stored, media.placeholder
+
+    with media.file.open('rb') as source:
+        data = source.read()
+    pool = _executor()
+    try:
+        rendered, placeholder = pool.submit(_render, data, specs).result()
+    except BrokenProcessPool:
+        # A render process died (e.g. killed for memory); the pool can't be used
+        # again, so later renders get a new one and this one is retried
+        _reset_executor(pool)
+        raise
+
+    for (name, storage, todo), contents in zip(missing, rendered):
+        for (fmt, stored_name, *_), content in zip(todo, contents):
+            stored_name = storage.save(stored_name, ContentFile(content))
+            stored[name][fmt] = {'name': stored_name, 'size': len(content)}
+    logger.info(f"Rendered {sum(len(todo) for _, _, todo in missing)} rendition files of media {media.id}")
+    return stored, placeholder
+
+
+def source_version(file_name):
+    """Short tag of the file an image has, which changes whenever the file is replaced."""
+    return hashlib.sha1(file_name.encode()).hexdigest()[:12]
+
+
+def _variant_path(media_id, source, width, height, fit, fmt):
+    return f'{media_id}/{source}/{width}x{height}/{fit}.{fmt}'
+
+
+def variant_signature(media_id, source, width, height, fit, fmt):
+    """The signature a variant URL must carry, so only URLs we hand out are rendered."""
+    return _variant_signer.signature(_variant_path(media_id, source, width, height, fit, fmt))
+
+
+def variant_url(media_id, file_name, width, height=0, fit='fit', fmt='jpg'):
+    """
+    Signed URL of image ``media_id``, whose file is ``file_name``, resized to
+    ``width`` x ``height``. With ``fit`` 'fit' it is scaled to fit the box (never
+    up; 0 leaves a side unconstrained), with 'fill' it is cropped to fill it.
+
+    The URL names the file's source_version, so replacing the image changes it
+    and responses cached for the old file are never reused.
+    """
+    source = source_version(file_name)
+    path = reverse('media_library:image_variant', kwargs={
+        'media_id': media_id, 'source': source, 'width': width, 'height': height, 'fit': fit, 'fmt': fmt,
+    })
+    return f'{path}?s={variant_signature(media_id, source, width, height, fit, fmt)}'
+
+
+def variant_format(accept):
+    """The format an "auto" variant is served in to a client sending ``accept``."""
+    accepted = accepted_formats(accept)
+    for fmt in ('avif', 'webp'):
+        if fmt in accepted and fmt in VARIANT_FORMATS:
+            return fmt
+    return 'jpg'
+
+
+def check_variant(width, height, fit, fmt):
+    """Raise ValueError unless a variant can be rendered with these parameters."""
+    if fit not in VARIANT_FITS:
+        raise ValueError(f"Unknown fit: {fit}")
+    if fmt not in VARIANT_FORMATS and fmt != VARIANT_AUTO:
+        raise ValueError(f"Unknown format: {fmt}")
+    if max(width, height) > settings.IMAGE_VARIANT_MAX_SIZE:
+        raise ValueError(f"Variants are at most {settings.IMAGE_VARIANT_MAX_SIZE}px")
+    if fit == 'fill' and not (width and height):
+        raise ValueError("'fill' needs a width and a height")
+    if not (width or height):
+        raise ValueError("A width or a height is needed")
+
+
+def _render_variant(source, width, height, fit, fmt):
+    img = open_image(io.BytesIO(source))
+    box = (width or 1, height or 1)
+    if img.getexif().get(0x0112) in _TRANSPOSED_ORIENTATIONS:
+        box = box[::-1]
+    # JPEGs are decoded at the smallest scale that still covers the box
+    img.draft('RGB', box)
+
+    if fit == 'fill':
+        resize = ResizeToFill(width, height)
+    else:
+        resize = ResizeToFit(width or None, height or None, upscale=False)
+    format, _content_type, options = VARIANT_FORMATS[fmt]
+    output = process_image(img, processors=[Transpose(), resize], format=format, options=options)
+    return output.getvalue()
+
+
+def get_or_render_variant(media_id, width, height, fit, fmt):
+    """
+    The ImageVariant of image ``media_id`` with these parameters (see
+    check_variant), rendering and storing it first if it doesn't exist yet.
+    Returns None if there is no such image.
+    """
+    from .models import ImageVariant, MediaFile
+
+    media = MediaFile.objects.filter(pk=media_id, file_type='image').only('id', 'file').first()
+    if media is None:
+        return None
+    source = media.file.name
+
+    # Variants of a file the image no longer has are never served again
+    stale = ImageVariant.objects.filter(media_id=media_id).exclude(source=source)
+    stale_keys = list(stale.values_list('storage_key', flat=True))
+    if stale_keys:
+        delete_names(stale_keys)
+        stale.delete()
+
+    with media.file.open('rb') as f:
+        data = _render_variant(f.read(), width, height, fit, fmt)
+    name = default_storage.save(
+        f'{VARIANT_PREFIX}/{media_id}/{source_version(source)}/{width}x{height}-{fit}.{fmt}', ContentFile(data)
+    )
+
+    lookup = {'media_id': media_id, 'source': source, 'width': width, 'height': height, 'fit': fit, 'format': fmt}
+    try:
+        variant, created = ImageVariant.objects.get_or_create(**lookup, defaults={
+            'storage_key': name,
+            'size': len(data),
+            'etag': f'"{hashlib.md5(data).hexdigest()}"',
+        })
+    except IntegrityError:
+        variant, created = ImageVariant.objects.get(**lookup), False
+    if not created:
+        # Another request rendered it at the same time
+        default_storage.delete(name)
+    else:
+        logger.info(f"Rendered variant {_variant_path(media_id, source_version(source), width, height, fit, fmt)}")
+    return variant
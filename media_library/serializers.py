@@ -1,4 +1,3 @@
-from django.conf import settings
 from rest_framework import serializers
 
 from media_library.models import MediaCategory, MediaFile
@@ -17,6 +16,9 @@ class MediaFileSerializer(serializers.ModelSerializer):
             "html_index_path",
             "html_base_dir",
             "original_zip_path",
+            "html_storage_mode",
+            "processing_status",
+            "processing_heartbeat_at",
             "is_processed",
             "processing_error",
             "uploaded_at",
@@ -32,7 +34,7 @@ class MediaFileSerializer(serializers.ModelSerializer):
         if obj.file is None:
             return None
         if obj.is_html:
-            return request.build_absolute_uri(f"{settings.MEDIA_URL}{obj.html_index_path}")
+            return request.build_absolute_uri(self.get_url_without_host(obj))
 
         return request.build_absolute_uri(obj.file.url)
 
@@ -41,7 +43,7 @@ class MediaFileSerializer(serializers.ModelSerializer):
         if obj.file is None:
             return None
         if obj.is_html:
-            return f"{settings.MEDIA_URL}{obj.html_index_path}"
+            return obj.html_site_url
         return obj.file.url
 
     def validate(self, attrs):
@@ -1,21 +1,64 @@
-from django.db.models.signals import post_delete, post_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
 
-from media_library.models import MediaFile
+from media_library.models import MediaFile, ProcessingStatus
 
 
 # Signal handlers for background processing
 @receiver(post_save, sender=MediaFile)
 def trigger_media_processing(sender, instance, created, **kwargs):
-    if instance.is_html and not instance.is_processed:
+    if instance.is_html and instance.processing_status == ProcessingStatus.PENDING:
+        from .progress import clear_progress
         from .tasks import process_html_zip_file
-        process_html_zip_file.send(instance.id)
-        # Mark as processed to avoid duplicate processing
-        MediaFile.objects.filter(id=instance.id).update(is_processed=True)
+        # Sent after commit so the worker sees the row; duplicates are harmless
+        # because only one worker can claim the site
+        media_id = instance.id
+
+        def enqueue():
+            # Progress of an earlier upload no longer applies
+            clear_progress(media_id)
+            process_html_zip_file.send(media_id)
+
+        transaction.on_commit(enqueue)
+
+
+@receiver(post_save, sender=MediaFile)
+def trigger_rendition_generation(sender, instance, created, **kwargs):
+    # Only for a new or replaced file: other saves (e.g. a title edited while the
+    # render runs) would start duplicate renders
+    if instance.file_type == 'image' and not instance.renditions_ready and getattr(instance, '_file_changed', False):
+        from .tasks import generate_renditions
+        media_id = instance.id
+        transaction.on_commit(lambda: generate_renditions.send(media_id))
+
+
+@receiver(pre_delete, sender=MediaFile)
+def collect_html_blobs(sender, instance, **kwargs):
+    # The manifest is cascade-deleted with the media, so remember its shared blobs now
+    if instance.is_html:
+        from .utils import BLOB_PREFIX
+        instance._html_blob_keys = list(
+            instance.html_assets.filter(storage_key__startswith=f'{BLOB_PREFIX}/')
+            .values_list('storage_key', flat=True)
+            .distinct()
+        )
 
 
 @receiver(post_delete, sender=MediaFile)
 def trigger_cleanup(sender, instance, **kwargs):
     if instance.is_html:
         from .tasks import cleanup_html_site
-        cleanup_html_site.send(instance.id)
\ No newline at end of file
+        cleanup_html_site.send(instance.id, getattr(instance, '_html_blob_keys', []))
+    elif instance.file_type == 'image':
+        from .tasks import cleanup_image_variants
+        cleanup_image_variants.send(instance.id)
+
+
+@receiver(post_save, sender=MediaFile)
+@receiver(post_delete, sender=MediaFile)
+def invalidate_site_route(sender, instance, **kwargs):
+    # After commit, so no worker can cache the old row again in the meantime
+    from .cache import invalidate_site
+    media_id = instance.pk
+    transaction.on_commit(lambda: invalidate_site(media_id))
@@ -0,0 +1,570 @@
+# media_library/storage.py
+import fcntl
+import hashlib
+import io
+import logging
+import mmap
+import os
+import posixpath
+import tempfile
+import threading
+import time
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from storages.backends.s3 import S3Storage
+from storages.utils import clean_name
+
+logger = logging.getLogger('media_library')
+
+
+# S3 DeleteObjects accepts at most this many keys per request
+DELETE_BATCH_SIZE = 1000
+
+
+def is_s3(storage=None):
+    """Return True when ``storage`` (default: default_storage) is an S3 backend."""
+    return hasattr(storage or default_storage, "bucket")
+
+
+_client_lock = threading.Lock()
+
+
+def s3_client(storage=None):
+    """
+    The process-wide S3 client of ``storage`` (default: default_storage).
+
+    boto3 clients are thread-safe, so every media_library transfer, from any
+    thread, shares this one client and its connection pool (sized and tuned by
+    AWS_S3_CLIENT_CONFIG). The storage backend's own connections are per thread,
+    each with a separate pool and TLS handshakes.
+    """
+    storage = storage or default_storage
+    shared = getattr(storage, "_shared_client", None)
+    if shared is None or shared[0] != os.getpid():
+        with _client_lock:
+            shared = getattr(storage, "_shared_client", None)
+            # A forked child must not reuse its parent's sockets
+            if shared is None or shared[0] != os.getpid():
+                client = storage._create_session().client(
+                    "s3",
+                    region_name=storage.region_name,
+                    use_ssl=storage.use_ssl,
+                    endpoint_url=storage.endpoint_url,
+                    config=storage.client_config,
+                    verify=storage.verify,
+                )
+                shared = storage._shared_client = (os.getpid(), client)
+    return shared[1]
+
+
+def s3_pool_stats(storage=None):
+    """
+    Connection pool usage of the shared S3 client, per upstream host.
+
+    ``idle`` connections are ready for reuse; ``opened`` counts every
+    connection the pool has created, so a steadily growing number means the
+    pool is too small for the traffic.
+    """
+    client = s3_client(storage)
+    stats = {"max_pool_connections": client.meta.config.max_pool_connections, "pools": []}
+    # botocore doesn't expose its urllib3 pool manager publicly
+    manager = client._endpoint.http_session._manager
+    for key in list(manager.pools.keys()):
+        pool = manager.pools.get(key)
+        if pool is None:
+            continue
+        stats["pools"].append({
+            "host": pool.host,
+            "opened": pool.num_connections,
+            "requests": pool.num_requests,
+            # The queue is padded with None placeholders up to the pool size
+            "idle": sum(conn is not None for conn in list(pool.pool.queue)) if pool.pool else 0,
+        })
+    return stats
+
+
+def storage_key(name, storage=None):
+    """Return the S3 object key for a storage-relative name (includes the storage location)."""
+    storage = storage or default_storage
+    return storage._normalize_name(clean_name(name))
+
+
+def _local_path(name, storage=None):
+    try:
+        return (storage or default_storage).path(name)
+    except NotImplementedError:
+        return None
+
+
+class _StreamReader:
+    """
+    Read-only, non-seekable view of a file object.
+
+    boto3 probes seekable streams for their size by seeking to the end, which for a
+    zip member means decompressing it twice. Hiding ``seek`` makes it upload the
+    member part by part instead.
+    """
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+    def read(self, size=-1):
+        return self._fileobj.read(size)
+
+
+class _DiskCache:
+    """
+    Size-bounded on-disk LRU of object bodies, shared by all processes on a host.
+
+    Entries are filled atomically (written to a temp file, then renamed) and a
+    miss is fetched once: concurrent readers of the same key, in this process or
+    another, wait on a per-key lock and then read the finished file. Reads bump
+    the file's mtime, and the least recently read files are evicted once the
+    directory grows past ``max_bytes``.
+    """
+
+    # Lock files of entries that have been evicted are removed after this long
+    LOCK_MAX_AGE = 3600
+    # and so are the temp files of fills that never finished (their process died)
+    TMP_MAX_AGE = 3600
+    # Threads of a process wait on one of this many locks, picked by key
+    LOCK_STRIPES = 64
+
+    def __init__(self, root, max_bytes, max_object_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_object_bytes = max_object_bytes
+        self._locks = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
+        self._evict_lock = threading.Lock()
+        # Scan the directory (sweeping what crashed fills left) on the first fill,
+        # then whenever another tenth has been added
+        self._added_bytes = max_bytes // 10
+
+    def _path(self, key):
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _open_entry(self, path):
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return f
+
+    def _key_lock(self, path):
+        # A fixed set, so the locks don't pile up with every key ever read
+        return self._locks[hash(path) % self.LOCK_STRIPES]
+
+    def get(self, key):
+        """Return the cached body of ``key`` opened for reading, or None."""
+        return self._open_entry(self._path(key))
+
+    def open(self, key, fetch):
+        """
+        Return the body of ``key`` opened for reading, filling the cache on a miss.
+
+        ``fetch()`` must return ``(fileobj, size)``. Bodies larger than
+        ``max_object_bytes`` are not cached; the fetched file object is returned.
+        """
+        path = self._path(key)
+        f = self._open_entry(path)
+        if f is not None:
+            return f
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        lock_path = os.path.join(directory, ".lock-" + os.path.basename(path))
+        with self._key_lock(path), open(lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # Someone else may have filled it while we waited
+                f = self._open_entry(path)
+                if f is not None:
+                    return f
+
+                source, size = fetch()
+                if size > self.max_object_bytes:
+                    return source
+
+                fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+                try:
+                    with os.fdopen(fd, "wb") as tmp, source:
+                        while chunk := source.read(settings.HTML_SITE_CHUNK_SIZE):
+                            tmp.write(chunk)
+                    os.replace(tmp_path, path)
+                except BaseException:
+                    os.unlink(tmp_path)
+                    raise
+                f = open(path, "rb")
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        self._added(size)
+        return f
+
+    def discard(self, key):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _added(self, size):
+        self._added_bytes += size
+        if self._added_bytes < self.max_bytes // 10 or not self._evict_lock.acquire(blocking=False):
+            return
+        try:
+            self._added_bytes = 0
+            self._evict()
+        except OSError as e:
+            logger.warning(f"Disk cache eviction in {self.root} failed: {e}")
+        finally:
+            self._evict_lock.release()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        now = time.time()
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.startswith(".lock-"):
+                    if now - stat.st_mtime > self.LOCK_MAX_AGE and not os.path.exists(
+                        os.path.join(shard.path, entry.name[len(".lock-"):])
+                    ):
+                        os.unlink(entry.path)
+                elif entry.name.startswith(".tmp-"):
+                    if now - stat.st_mtime > self.TMP_MAX_AGE:
+                        os.unlink(entry.path)
+                elif not entry.name.startswith("."):
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+
+        if total <= self.max_bytes:
+            return
+
+        # Evict down to 90% so the next scan isn't due straight away
+        target = self.max_bytes * 0.9
+        removed = 0
+        for _mtime, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            removed += 1
+        logger.info(f"Evicted {removed} files from the disk cache in {self.root}")
+
+
+class CachedS3Storage(S3Storage):
+    """
+    S3Storage that keeps object bodies it reads on local disk (S3_DISK_CACHE_*).
+
+    Reads of cached objects don't touch S3. Objects are cached by name, which is
+    safe for uploads and renditions (their names are never reused); files that
+    are overwritten in place are read through ``open_cached`` with a version.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.disk_cache = _DiskCache(
+            settings.S3_DISK_CACHE_DIR,
+            settings.S3_DISK_CACHE_MAX_BYTES,
+            settings.S3_DISK_CACHE_MAX_OBJECT,
+        )
+
+    @staticmethod
+    def _cache_key(name, version=None):
+        name = clean_name(name)
+        return name if version is None else f"{name}@{version}"
+
+    def open_cached(self, name, version=None):
+        """
+        Open ``name`` for reading from the disk cache, fetching it on a miss.
+
+        ``version`` (e.g. a content hash) is part of the cache key, so a file
+        overwritten under the same name is never read back stale.
+        """
+        def fetch():
+            try:
+                response = s3_client(self).get_object(
+                    Bucket=self.bucket_name,
+                    Key=storage_key(name, self),
+                )
+            except ClientError as err:
+                if err.response["ResponseMetadata"]["HTTPStatusCode"] == 404:
+                    raise FileNotFoundError(f"File does not exist: {name}")
+                raise
+            return response["Body"], response["ContentLength"]
+
+        return self.disk_cache.open(self._cache_key(name, version), fetch)
+
+    def cached(self, name, version=None):
+        """Return ``name`` opened from the disk cache if it is there, else None."""
+        return self.disk_cache.get(self._cache_key(name, version))
+
+    def forget(self, name):
+        self.disk_cache.discard(self._cache_key(name))
+
+    def _open(self, name, mode="rb"):
+        if mode != "rb":
+            return super()._open(name, mode)
+        return File(self.open_cached(name), name)
+
+    def _save(self, name, content):
+        name = super()._save(name, content)
+        self.forget(name)
+        return name
+
+    def delete(self, name):
+        super().delete(name)
+        self.forget(name)
+
+
+def save_stream(name, source, size, content_type, content_encoding=""):
+    """
+    Write ``source`` to ``name``, overwriting whatever is stored there.
+
+    ``size`` is the number of bytes ``source`` will produce (None if unknown).
+    On S3 bodies known to be below the multipart threshold of
+    AWS_S3_TRANSFER_CONFIG are sent in one request; anything else is uploaded
+    in parallel parts, each retried on its own. ``content_encoding`` is stored
+    as object metadata, so the object can be fetched directly from the bucket/CDN.
+    """
+    chunk_size = settings.HTML_SITE_CHUNK_SIZE
+
+    if is_s3():
+        key = storage_key(name)
+        extra_args = {"ContentType": content_type}
+        if content_encoding:
+            extra_args["ContentEncoding"] = content_encoding
+        config = default_storage.transfer_config
+        if size is not None and size <= config.multipart_threshold:
+            s3_client().put_object(
+                Bucket=default_storage.bucket_name,
+                Key=key,
+                Body=source.read(),
+                **extra_args,
+            )
+        else:
+            s3_client().upload_fileobj(
+                _StreamReader(source),
+                default_storage.bucket_name,
+                key,
+                ExtraArgs=extra_args,
+                Config=config,
+            )
+        if isinstance(default_storage, CachedS3Storage):
+            default_storage.forget(name)
+        return
+
+    path = _local_path(name)
+    if path is None:
+        # Generic backend without overwrite support
+        default_storage.delete(name)
+        default_storage.save(name, File(source))
+        return
+
+    # Write next to the target and rename over it, so readers never see a partial file
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while chunk := source.read(chunk_size):
+                f.write(chunk)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class _RangeReader:
+    """Reads at most ``length`` bytes from ``fileobj``."""
+
+    def __init__(self, fileobj, length):
+        self._fileobj = fileobj
+        self._remaining = length
+
+    def read(self, size=-1):
+        if self._remaining <= 0:
+            return b""
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._fileobj.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        self._fileobj.close()
+
+
+def open_stream(name, start=None, end=None, version=None):
+    """
+    Open ``name`` for reading with a single storage request.
+
+    On S3 ``default_storage.open`` HEADs the object and then downloads all of it
+    before the first byte can be returned; this streams the GetObject body instead.
+    When ``start``/``end`` (inclusive) are given only that byte range is read, with
+    a ranged GetObject on S3 and through mmap locally. With CachedS3Storage
+    whole-file reads go through the disk cache, keyed by ``version`` when given.
+    """
+    if isinstance(default_storage, CachedS3Storage):
+        if start is None:
+            return default_storage.open_cached(name, version)
+        # Ranges are served from disk if the file is there, but never fill it
+        file_obj = default_storage.cached(name, version)
+        if file_obj is not None:
+            file_obj.seek(start)
+            return _RangeReader(file_obj, end - start + 1)
+
+    if is_s3():
+        params = {}
+        if start is not None:
+            params["Range"] = f"bytes={start}-{end}"
+        response = s3_client().get_object(
+            Bucket=default_storage.bucket_name,
+            Key=storage_key(name),
+            **params,
+        )
+        return response["Body"]
+
+    if start is None:
+        return default_storage.open(name, "rb")
+
+    path = _local_path(name)
+    if path is None:
+        file_obj = default_storage.open(name, "rb")
+    else:
+        # Map the file rather than reading through a buffered file object; the
+        # pages come straight from the page cache and stay shared between workers
+        with open(path, "rb") as f:
+            file_obj = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    file_obj.seek(start)
+    return _RangeReader(file_obj, end - start + 1)
+
+
+class RangedFile(io.RawIOBase):
+    """
+    Seekable, read-only view of stored file ``name`` that fetches each read with
+    its own ranged request (see open_stream), so a reader that only needs part of
+    a large object never downloads the rest.
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self._pos = offset
+        return offset
+
+    def readinto(self, buffer):
+        length = min(len(buffer), self.size - self._pos)
+        if length <= 0:
+            return 0
+        body = open_stream(self.name, self._pos, self._pos + length - 1)
+        try:
+            view = memoryview(buffer)
+            read = 0
+            while read < length:
+                data = body.read(length - read)
+                if not data:
+                    raise OSError(f"{self.name} ended early at {self._pos + read}")
+                view[read:read + len(data)] = data
+                read += len(data)
+        finally:
+            body.close()
+        self._pos += length
+        return length
+
+
+def list_prefix_sizes(prefix):
+    """Map the storage-relative name of every file stored under ``prefix``/ to its size."""
+    prefix = prefix.rstrip("/")
+
+    if is_s3():
+        key_prefix = storage_key(prefix) + "/"
+        paginator = s3_client().get_paginator("list_objects_v2")
+        sizes = {}
+        for page in paginator.paginate(Bucket=default_storage.bucket_name, Prefix=key_prefix):
+            for entry in page.get("Contents", ()):
+                sizes[posixpath.join(prefix, entry["Key"][len(key_prefix):])] = entry["Size"]
+        return sizes
+
+    root = _local_path(prefix)
+    if root is None:
+        raise NotImplementedError("Listing is only supported for S3 and local storage")
+
+    sizes = {}
+    for dirpath, _dirnames, filenames in os.walk(root):
+        relative_dir = os.path.relpath(dirpath, root)
+        for filename in filenames:
+            name = posixpath.normpath(posixpath.join(prefix, relative_dir, filename))
+            try:
+                sizes[name] = os.path.getsize(os.path.join(dirpath, filename))
+            except FileNotFoundError:
+                continue
+    return sizes
+
+
+def list_prefix(prefix):
+    """Return the storage-relative names of every file stored under ``prefix``/."""
+    return set(list_prefix_sizes(prefix))
+
+
+def delete_names(names):
+    """Delete storage-relative ``names``, batching the requests on S3."""
+    names = sorted(names)
+
+    if is_s3():
+        client = s3_client()
+        for start in range(0, len(names), DELETE_BATCH_SIZE):
+            batch = names[start:start + DELETE_BATCH_SIZE]
+            response = client.delete_objects(
+                Bucket=default_storage.bucket_name,
+                Delete={
+                    "Objects": [{"Key": storage_key(name)} for name in batch],
+                    "Quiet": True,
+                },
+            )
+            if response.get("Errors"):
+                error = response["Errors"][0]
+                raise OSError(
+                    f"Failed to delete {len(response['Errors'])} objects, "
+                    f"first was {error['Key']}: {error['Message']}"
+                )
+        if isinstance(default_storage, CachedS3Storage):
+            for name in names:
+                default_storage.forget(name)
+        return
+
+    for name in names:
+        default_storage.delete(name)
@@ -2,32 +2,274 @@
 import logging
 import os
 import shutil
+import threading
+import zipfile
+from contextlib import contextmanager
 from django.conf import settings
+from django.db import connections
 import dramatiq
-from .utils import process_html_zip_file_now
+from .progress import ExtractionProgress
+from .renditions import VARIANT_PREFIX, render_renditions
+from .storage import delete_names, is_s3, list_prefix
+from .utils import (
+    InvalidArchive,
+    ProcessingSuperseded,
+    delete_old_site_versions,
+    delete_unreferenced_blobs,
+    plan_html_zip_shards,
+    process_html_zip_file_now,
+    store_html_zip_members,
+)
 
 logger = logging.getLogger('media_library')
 
 
-@dramatiq.actor
+@contextmanager
+def heartbeat(media_id, claim):
+    """Renew processing claim ``claim`` of ``media_id`` from a background thread while the block runs."""
+    from .models import MediaFile
+
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(settings.HTML_SITE_PROCESSING_LEASE / 5):
+                try:
+                    if not MediaFile.renew_processing(media_id, claim):
+                        logger.warning(f"Processing claim of media {media_id} was lost")
+                        return
+                except Exception as e:
+                    logger.warning(f"Failed to renew processing claim of media {media_id}: {e}")
+        finally:
+            connections.close_all()
+
+    thread = threading.Thread(target=beat, name=f"html-site-heartbeat-{media_id}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+@dramatiq.actor(
+    time_limit=settings.HTML_SITE_PROCESSING_TIMEOUT * 1000,
+    max_retries=settings.HTML_SITE_PROCESSING_RETRIES,
+    on_retry_exhausted="html_site_processing_failed",
+)
 def process_html_zip_file(media_id):
     """Process a zip file containing an HTML website."""
     # Import here to avoid AppRegistryNotReady errors
-    from .models import MediaFile
+    from .models import MediaFile, ProcessingStatus
+
+    # Only one worker gets to process a site, however many messages were sent
+    media = MediaFile.claim_processing(media_id)
+    if media is None:
+        if MediaFile.objects.filter(pk=media_id, processing_status=ProcessingStatus.PROCESSING).exists():
+            # Another worker holds the claim; come back once it would have expired
+            raise dramatiq.Retry(delay=settings.HTML_SITE_PROCESSING_LEASE * 1000)
+        logger.info(f"MediaFile {media_id} is not pending processing, skipping")
+        return
 
     try:
-        media = MediaFile.objects.get(id=media_id)
-        media = process_html_zip_file_now(media)
-        if media:
-            media.save(update_fields=['html_index_path', 'original_zip_path', 'html_base_dir'])
-    except MediaFile.DoesNotExist:
-        logger.warning(f"MediaFile with ID {media_id} not found")
+        with heartbeat(media_id, media.processing_claim):
+            batches = plan_html_zip_shards(media)
+            if batches:
+                # Each batch is stored by whichever worker picks it up; the site is
+                # finished (manifest, index, status) once all of them are done
+                archive_name, claim = media.file.name, media.processing_claim
+                shards = dramatiq.group(
+                    store_html_zip_shard.message(media_id, archive_name, claim, names) for names in batches
+                )
+                shards.add_completion_callback(finish_html_zip_shards.message(media_id, archive_name, claim))
+                shards.run()
+                return
+            # Saves the outcome (status, paths, error) unless the upload changed meanwhile.
+            # An empty plan means earlier shards stored every member, so only the
+            # finishing step is left, which needs just the archive's central directory
+            process_html_zip_file_now(media, ranged=batches is not None)
+    except ProcessingSuperseded as e:
+        # The message sent for the new upload takes over
+        logger.info(f"{e}, discarded")
+        return
+    except (zipfile.BadZipFile, InvalidArchive) as e:
+        # Retrying won't fix the upload itself
+        logger.error(f"Error processing HTML zip file: {e}")
+        _save_failure(media, e)
+        return
     except Exception as e:
+        # Hand the site back and let the Retries middleware try again; the next
+        # run resumes from the members this one stored
+        logger.error(f"Error processing HTML zip file, will retry: {e}")
+        # An update rather than save(), which would queue yet another message, and
+        # only while this run holds the claim: a run that took it over owns the status
+        handed_back = MediaFile.objects.filter(
+            pk=media_id, file=media.file.name, processing_claim=media.processing_claim
+        ).update(processing_status=ProcessingStatus.PENDING, processing_error=media.processing_error)
+        if handed_back:
+            ExtractionProgress(media_id).set_status(ProcessingStatus.PENDING, media.processing_error)
+        raise
+    schedule_version_collection(media)
+
+
+def _save_failure(media, error):
+    """Mark ``media`` as failed with ``error``, unless its ZIP was replaced meanwhile."""
+    from .models import ProcessingStatus
+
+    media.processing_status = ProcessingStatus.FAILED
+    media.processing_error = str(error)
+    if media.save_processing_result(media.html_version):
+        ExtractionProgress(media.id).set_status(media.processing_status, media.processing_error)
+
+
+@dramatiq.actor
+def html_site_processing_failed(message_data, retry_info):
+    """Mark an HTML site as failed once process_html_zip_file has run out of retries."""
+    from .models import MediaFile, ProcessingStatus
+
+    media_id = message_data["args"][0]
+    # Only if no newer upload has been queued in the meantime
+    updated = MediaFile.objects.filter(pk=media_id, processing_status=ProcessingStatus.PENDING).update(
+        processing_status=ProcessingStatus.FAILED
+    )
+    if updated:
+        ExtractionProgress(media_id).set_status(ProcessingStatus.FAILED)
+        logger.error(f"Gave up processing HTML site {media_id} after {retry_info.get('retries')} attempts")
+
+
+@dramatiq.actor(max_retries=3)
+def generate_renditions(media_id):
+    """Render the thumbnail/medium renditions and the placeholder of an uploaded image."""
+    from .models import MediaFile
+
+    media = MediaFile.objects.filter(pk=media_id, file_type='image').first()
+    if media is None or (media.renditions_ready and media.placeholder):
+        return
+    file_name = media.file.name
+    renditions, placeholder = render_renditions(media)
+    # Unless the image was replaced meanwhile; its own message renders the new one
+    MediaFile.objects.filter(pk=media_id, file=file_name).update(
+        renditions_ready=True, renditions=renditions, placeholder=placeholder
+    )
+
+
+@dramatiq.actor
+def cleanup_image_variants(media_id):
+    """Delete the on-demand variants of an image when the media is deleted."""
+    delete_names(list_prefix(f'{VARIANT_PREFIX}/{media_id}'))
+
+
+def _sharded_media(media_id, archive_name, claim):
+    """
+    The media a shard message belongs to, or None if its claim is no longer held
+    (the media was deleted or re-uploaded, or the claim lapsed and was taken over).
+    """
+    from .models import MediaFile
+
+    # Renewed before anything else, as the lease may have all but run out while
+    # the message was queued
+    media = None
+    if MediaFile.renew_processing(media_id, claim):
+        media = MediaFile.objects.filter(pk=media_id, file=archive_name).first()
+    if media is None:
+        logger.info(f"MediaFile {media_id} is no longer processing {archive_name} under this claim, skipping")
+    return media
+
+
+@dramatiq.actor(
+    time_limit=settings.HTML_SITE_PROCESSING_TIMEOUT * 1000,
+    max_retries=settings.HTML_SITE_PROCESSING_RETRIES,
+    on_retry_exhausted="html_site_shard_failed",
+)
+def store_html_zip_shard(media_id, archive_name, claim, filenames):
+    """Store one batch of the members of a sharded HTML site extraction."""
+    media = _sharded_media(media_id, archive_name, claim)
+    if media is None:
+        return
+    with heartbeat(media_id, claim):
+        store_html_zip_members(media, filenames)
+
+
+@dramatiq.actor(
+    time_limit=settings.HTML_SITE_PROCESSING_TIMEOUT * 1000,
+    max_retries=settings.HTML_SITE_PROCESSING_RETRIES,
+    on_retry_exhausted="html_site_shard_failed",
+)
+def finish_html_zip_shards(media_id, archive_name, claim):
+    """Finish a sharded HTML site extraction once every batch has been stored."""
+    media = _sharded_media(media_id, archive_name, claim)
+    if media is None:
+        return
+    try:
+        with heartbeat(media_id, claim):
+            # Picks the stored members up from the checkpoint, so only the manifest
+            # and the central directory of the archive are left to do
+            process_html_zip_file_now(media, ranged=True)
+    except ProcessingSuperseded as e:
+        logger.info(f"{e}, discarded")
+        return
+    except (zipfile.BadZipFile, InvalidArchive) as e:
         logger.error(f"Error processing HTML zip file: {e}")
+        _save_failure(media, e)
+        return
+    schedule_version_collection(media)
+
+
+@dramatiq.actor
+def html_site_shard_failed(message_data, retry_info):
+    """Mark an HTML site as failed once a step of its sharded extraction has run out of retries."""
+    from .models import MediaFile, ProcessingStatus
+
+    media_id, archive_name, claim = message_data["args"][:3]
+    error = f"{message_data['actor_name']} failed after {retry_info.get('retries')} attempts"
+    updated = MediaFile.objects.filter(
+        pk=media_id, file=archive_name, processing_status=ProcessingStatus.PROCESSING, processing_claim=claim
+    ).update(processing_status=ProcessingStatus.FAILED, processing_error=error)
+    if updated:
+        ExtractionProgress(media_id).set_status(ProcessingStatus.FAILED, error)
+        logger.error(f"Gave up processing HTML site {media_id}: {error}")
+
+
+def schedule_version_collection(media):
+    """
+    Have the versions of ``media`` older than the one it now serves deleted once
+    HTML_SITE_VERSION_GRACE has passed, so pages already loaded can finish.
+    """
+    from .models import ProcessingStatus
+
+    if media.processing_status == ProcessingStatus.READY:
+        collect_html_site_versions.send_with_options(
+            args=(media.id,), delay=settings.HTML_SITE_VERSION_GRACE * 1000
+        )
+
 
 @dramatiq.actor
-def cleanup_html_site(media_id):
+def collect_html_site_versions(media_id):
+    """Delete the stored files of the versions of an HTML site older than the live one."""
+    from .models import MediaFile
+
+    live = MediaFile.objects.filter(pk=media_id).values_list('html_version', 'html_base_dir').first()
+    # Deleted sites are removed entirely by cleanup_html_site
+    if live and live[0]:
+        delete_old_site_versions(media_id, *live)
+
+
+@dramatiq.actor
+def delete_html_blobs(names):
+    """Delete the shared HTML site blobs among ``names`` that still aren't used by any site."""
+    delete_unreferenced_blobs(names)
+
+
+@dramatiq.actor
+def cleanup_html_site(media_id, blob_keys=None):
     """Clean up extracted HTML site files when media is deleted."""
+    # Shared blobs the site used are only removed if no other site needs them
+    delete_unreferenced_blobs(blob_keys or [])
+
+    if is_s3():
+        delete_names(list_prefix(f'html_sites/{media_id}'))
+        return
+
     extract_dir = os.path.join(settings.MEDIA_ROOT, f'html_sites/{media_id}')
     if os.path.exists(extract_dir):
         shutil.rmtree(extract_dir)
@@ -0,0 +1,20 @@
+from itertools import takewhile
+
+from django import template
+from django.utils.html import format_html_join
+
+from ..renditions import NEGOTIATED_FORMATS
+
+register = template.Library()
+
+CONTENT_TYPES = {fmt: content_type for content_type, fmt in NEGOTIATED_FORMATS.items()}
+
+@register.simple_tag
+def rendition_sources(media, name):
+    """
+    <source> elements for the modern formats of rendition ``name`` of ``media``
+    that are smaller than its JPEG, smallest first, to put before the JPEG <img>
+    in a <picture>; the browser picks the first type it decodes.
+    """
+    smaller = takewhile(lambda item: item[0] in CONTENT_TYPES, media.rendition_urls(name).items())
+    return format_html_join('', '<source type="{}" srcset="{}">', ((CONTENT_TYPES[fmt], url) for fmt, url in smaller))
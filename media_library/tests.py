@@ -1,3 +1,188 @@
-from django.test import TestCase
+import base64
+import io
+import lzma
+import zipfile
+from datetime import timedelta
+from types import SimpleNamespace
 
-# Create your tests here.
+from django.conf import settings
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.utils import timezone
+from PIL import Image
+
+from .models import MediaFile, ProcessingStatus
+from .renditions import _render, image_dimensions
+from .utils import InvalidArchive, _LZMAReader, _member_jobs
+from .views import _UnsatisfiableRange, _accepted_encodings, _is_within, _parse_range, _pick_variant
+
+
+def _zip(*names):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_ref:
+        for name in names:
+            zip_ref.writestr(name, "<h1>site</h1>")
+    buffer.seek(0)
+    return zipfile.ZipFile(buffer)
+
+
+class MemberJobsTests(SimpleTestCase):
+    extract_base = "html_sites/2/v1"
+
+    def test_members_are_extracted_under_the_site(self):
+        members, jobs, index_path = _member_jobs(
+            _zip("site/index.html", "site/js/app.js", "site/js/../css/app.css"), self.extract_base
+        )
+        self.assertEqual(len(members), 3)
+        self.assertEqual(
+            [target_path for _, target_path, _ in jobs],
+            ["html_sites/2/v1/site/index.html", "html_sites/2/v1/site/js/app.js", "html_sites/2/v1/site/css/app.css"],
+        )
+        self.assertEqual(index_path, "html_sites/2/v1/site/index.html")
+
+    def test_members_outside_the_site_are_rejected(self):
+        for name in (
+            "../../1/v1/index.html",
+            "site/../../v10/index.html",
+            "..",
+            "/etc/passwd",
+            "C:/index.html",
+            "\\index.html",
+        ):
+            with self.subTest(name=name), self.assertRaises(InvalidArchive):
+                _member_jobs(_zip("index.html", name), self.extract_base)
+
+    def test_sibling_prefixes_are_rejected(self):
+        # "html_sites/2/v1" is a string prefix of "html_sites/2/v10"
+        with self.assertRaises(InvalidArchive):
+            _member_jobs(_zip("../v10/index.html"), self.extract_base)
+
+
+class IsWithinTests(SimpleTestCase):
+    def test_paths_below_the_base_are_within(self):
+        self.assertTrue(_is_within("html_sites/2/v1", "html_sites/2/v1"))
+        self.assertTrue(_is_within("html_sites/2/v1", "html_sites/2/v1/site/index.html"))
+
+    def test_sibling_prefixes_are_not_within(self):
+        self.assertFalse(_is_within("html_sites/2/v1", "html_sites/2/v10/index.html"))
+        self.assertFalse(_is_within("html_sites/2/v1/site", "html_sites/2/v1/site-old/index.html"))
+        self.assertFalse(_is_within("html_sites/2/v1", "/etc/passwd"))
+
+
+def _rotated_jpeg():
+    """A 400x300 JPEG whose EXIF orientation (6) says to show it rotated, 300x400."""
+    img = Image.new("RGB", (400, 300), "red")
+    exif = img.getexif()
+    exif[0x0112] = 6
+    buffer = io.BytesIO()
+    img.save(buffer, "JPEG", exif=exif)
+    return buffer.getvalue()
+
+
+class OrientationTests(SimpleTestCase):
+    def test_dimensions_are_as_displayed(self):
+        self.assertEqual(image_dimensions(io.BytesIO(_rotated_jpeg())), (300, 400))
+
+    def test_placeholder_has_the_displayed_shape(self):
+        _, placeholder = _render(_rotated_jpeg(), [])
+        data = base64.b64decode(placeholder.split(",", 1)[1])
+        with Image.open(io.BytesIO(data)) as img:
+            self.assertEqual(img.size, (12, 16))
+
+
+class ParseRangeTests(SimpleTestCase):
+    def test_ranges_within_the_body(self):
+        self.assertEqual(_parse_range("bytes=0-9", 100), (0, 9))
+        self.assertEqual(_parse_range("bytes=90-500", 100), (90, 99))
+
+    def test_open_ended_ranges_run_to_the_end(self):
+        self.assertEqual(_parse_range("bytes=90-", 100), (90, 99))
+
+    def test_suffix_ranges_are_the_last_bytes(self):
+        self.assertEqual(_parse_range("bytes=-10", 100), (90, 99))
+        self.assertEqual(_parse_range("bytes=-500", 100), (0, 99))
+
+    def test_ranges_outside_the_body_are_unsatisfiable(self):
+        for header, size in (("bytes=100-", 100), ("bytes=100-200", 100), ("bytes=-0", 100), ("bytes=-10", 0)):
+            with self.subTest(header=header, size=size), self.assertRaises(_UnsatisfiableRange):
+                _parse_range(header, size)
+
+    def test_other_headers_serve_the_full_body(self):
+        for header in ("", "items=0-9", "bytes=0-9,20-29", "bytes=9-0", "bytes=a-b", "bytes=5"):
+            with self.subTest(header=header):
+                self.assertIsNone(_parse_range(header, 100))
+
+
+class EncodingTests(SimpleTestCase):
+    asset = SimpleNamespace(variants={"br": {"size": 10}, "gzip": {"size": 20}})
+
+    def _accepted(self, header):
+        return _accepted_encodings(RequestFactory().get("/", HTTP_ACCEPT_ENCODING=header))
+
+    def test_encodings_with_q_0_are_refused(self):
+        self.assertEqual(self._accepted("gzip, br;q=0, deflate;q=0.5"), {"gzip", "deflate"})
+        self.assertEqual(self._accepted("br; q=0.0"), set())
+
+    def test_brotli_is_preferred(self):
+        self.assertEqual(_pick_variant(self.asset, self._accepted("gzip, br"))[0], "br")
+        self.assertEqual(_pick_variant(self.asset, self._accepted("*"))[0], "br")
+
+    def test_refused_encodings_are_not_picked(self):
+        self.assertEqual(_pick_variant(self.asset, self._accepted("gzip, br;q=0"))[0], "gzip")
+        self.assertEqual(_pick_variant(self.asset, self._accepted("br;q=0, gzip;q=0")), (None, None))
+        self.assertEqual(_pick_variant(SimpleNamespace(variants={}), self._accepted("br")), (None, None))
+
+
+class LZMAReaderTests(SimpleTestCase):
+    data = b'{"scene": 1}' * 10000
+
+    def test_reads_decompress_incrementally(self):
+        reader = _LZMAReader(io.BytesIO(lzma.compress(self.data)), len(self.data))
+        chunks = list(iter(lambda: reader.read(1000), b""))
+        self.assertTrue(all(len(chunk) <= 1000 for chunk in chunks))
+        self.assertEqual(b"".join(chunks), self.data)
+        self.assertEqual(reader.size, len(self.data))
+
+    def test_read_all(self):
+        self.assertEqual(_LZMAReader(io.BytesIO(lzma.compress(self.data)), len(self.data)).read(), self.data)
+
+    def test_output_beyond_the_limit_is_refused(self):
+        reader = _LZMAReader(io.BytesIO(lzma.compress(self.data)), len(self.data) - 1)
+        with self.assertRaises(lzma.LZMAError):
+            reader.read()
+
+    def test_truncated_streams_are_refused(self):
+        reader = _LZMAReader(io.BytesIO(lzma.compress(self.data)[:-20]), len(self.data))
+        with self.assertRaises(lzma.LZMAError):
+            reader.read()
+
+
+class ClaimProcessingTests(TestCase):
+    def setUp(self):
+        self.media = MediaFile.objects.create(title="site", file="2026/10/site.zip", is_html=True)
+
+    def test_a_pending_site_is_claimed_once(self):
+        claimed = MediaFile.claim_processing(self.media.id)
+        self.assertEqual(claimed.processing_status, ProcessingStatus.PROCESSING)
+        self.assertTrue(claimed.processing_claim)
+        self.assertIsNone(MediaFile.claim_processing(self.media.id))
+
+    def test_a_live_claim_is_not_taken_over(self):
+        claimed = MediaFile.claim_processing(self.media.id)
+        self.assertTrue(MediaFile.renew_processing(self.media.id, claimed.processing_claim))
+        self.assertIsNone(MediaFile.claim_processing(self.media.id))
+
+    def test_an_abandoned_claim_is_taken_over(self):
+        claimed = MediaFile.claim_processing(self.media.id)
+        MediaFile.objects.filter(pk=self.media.id).update(
+            processing_heartbeat_at=timezone.now() - timedelta(seconds=settings.HTML_SITE_PROCESSING_LEASE + 1)
+        )
+        taken_over = MediaFile.claim_processing(self.media.id)
+        self.assertIsNotNone(taken_over)
+        self.assertNotEqual(taken_over.processing_claim, claimed.processing_claim)
+        # The first claim's holder finds out when it next renews
+        self.assertFalse(MediaFile.renew_processing(self.media.id, claimed.processing_claim))
+        self.assertTrue(MediaFile.renew_processing(self.media.id, taken_over.processing_claim))
+
+    def test_ready_sites_are_not_claimed(self):
+        MediaFile.objects.filter(pk=self.media.id).update(processing_status=ProcessingStatus.READY)
+        self.assertIsNone(MediaFile.claim_processing(self.media.id))
@@ -19,13 +19,18 @@ urlpatterns = [
     path('category/<slug:slug>/', views.media_category, name='media_category'),
     path('html-site/<int:media_id>/', views.serve_html_site, name='serve_html_site'),
     re_path(r'^html-site/(?P<media_id>\d+)/(?P<path>.+)$', views.serve_html_site, name='serve_html_site_path'),
+    path('img/<int:media_id>/<slug:source>/<int:width>x<int:height>/<slug:fit>.<slug:fmt>', views.serve_image_variant,
+         name='image_variant'),
 
     # API
     path('api/track-usage/', api_views.track_media_usage, name='api_track_usage'),
     path('api/remove-usage/', api_views.remove_media_usage, name='api_remove_usage'),
     path('api/media-list/', api_views.media_list, name='api_media_list'),
     path('api/media-detail/<int:pk>/', api_views.media_detail, name='api_media_detail'),
+    path('api/media-status/<int:pk>/', api_views.media_status, name='api_media_status'),
+    path('api/media-status/<int:pk>/stream/', api_views.media_status_stream, name='api_media_status_stream'),
     path('api/categories/', api_views.category_list, name='api_category_list'),
     path('api/upload-media/', api_views.upload_media, name='api_upload_media'),
+    path('api/storage-pool-stats/', api_views.storage_pool_stats, name='api_storage_pool_stats'),
     path("", include(router.urls)),
 ]
@@ -1,118 +1,1044 @@
+import hashlib
+import heapq
+import io
+import json
 import logging
+import lzma
+import mimetypes
+import ntpath
 import os
+import re
+import tempfile
+import threading
+import time
 import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional, only gzip variants are produced without it
+    brotli = None
+
+from .progress import PHASE_DOWNLOADING, PHASE_FINALIZING, ExtractionProgress
+from .storage import RangedFile, delete_names, list_prefix, list_prefix_sizes, s3_client, save_stream, storage_key
 
 
 logger = logging.getLogger('media_library')
 
+# Content-addressed HTML site files shared between sites
+BLOB_PREFIX = "html_blobs"
+
+# Reads of a ranged archive smaller than this are rounded up to it, so member
+# headers and small members cost one request rather than several
+RANGED_READ_BUFFER = 256 * 1024
+
+# Content types that mimetypes gets wrong (or doesn't know) for Verge3D assets
+CONTENT_TYPE_OVERRIDES = {
+    ".js": "application/javascript",
+    ".wasm": "application/wasm",
+    ".gltf": "model/gltf+json",
+    ".css": "text/css",
+}
+
+
+# Text-like assets that get precompressed .gz/.br siblings at extraction time
+COMPRESSIBLE_CONTENT_TYPES = {
+    "application/javascript",
+    "application/json",
+    "application/wasm",
+    "application/xml",
+    "image/svg+xml",
+    "model/gltf+json",
+}
+
+# Storage name suffix of each precompressed variant, by Content-Encoding
+VARIANT_SUFFIXES = {
+    "br": ".br",
+    "gzip": ".gz",
+}
+
+
+def guess_content_type(path):
+    """Return the Content-Type to store/serve for ``path``."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in CONTENT_TYPE_OVERRIDES:
+        return CONTENT_TYPE_OVERRIDES[ext]
+    content_type, _ = mimetypes.guess_type(path)
+    return content_type or "application/octet-stream"
+
+
+@contextmanager
+def open_media_file_seekable(media, ranged=False):
+    """
+    Yield a seekable binary file object for ``media.file`` without loading it into RAM.
+
+    Local files are opened in place. Remote files are copied into a spooled temporary
+    file which rolls over to disk once it grows past HTML_SITE_SPOOL_MAX_MEMORY, or,
+    with ``ranged``, read on demand with ranged requests (for callers that only need
+    some of the members).
+    """
+    storage = media.file.storage
+
+    try:
+        local_path = storage.path(media.file.name)
+    except NotImplementedError:
+        local_path = None
+
+    if local_path:
+        with open(local_path, "rb") as f:
+            yield f
+        return
+
+    if ranged:
+        raw = RangedFile(media.file.name, storage.size(media.file.name))
+        with io.BufferedReader(raw, RANGED_READ_BUFFER) as f:
+            yield f
+        return
+
+    with tempfile.SpooledTemporaryFile(max_size=settings.HTML_SITE_SPOOL_MAX_MEMORY) as spool:
+        if hasattr(storage, "bucket"):
+            s3_client(storage).download_fileobj(
+                storage.bucket_name,
+                storage_key(media.file.name, storage),
+                spool,
+                Config=storage.transfer_config,
+            )
+        else:
+            with storage.open(media.file.name, "rb") as f:
+                for chunk in f.chunks(settings.HTML_SITE_CHUNK_SIZE):
+                    spool.write(chunk)
+        spool.seek(0)
+        yield spool
+
+
+class InvalidArchive(ValueError):
+    """The uploaded ZIP can never be processed (retrying won't help)."""
+
+
+class ProcessingSuperseded(Exception):
+    """The ZIP was replaced, or another run finished the site, while it was being processed."""
+
+
+def _check_archive_limits(members):
+    """Reject archives that exceed the configured member count / uncompressed size caps."""
+    if len(members) > settings.HTML_SITE_MAX_MEMBERS:
+        raise InvalidArchive(
+            f"ZIP contains {len(members)} files, the limit is {settings.HTML_SITE_MAX_MEMBERS}"
+        )
+
+    total_size = sum(info.file_size for info in members)
+    if total_size > settings.HTML_SITE_MAX_UNCOMPRESSED_BYTES:
+        raise InvalidArchive(
+            f"ZIP expands to {total_size} bytes, the limit is "
+            f"{settings.HTML_SITE_MAX_UNCOMPRESSED_BYTES}"
+        )
+
+
+class _ByteBudget:
+    """Blocks producers while more than ``limit`` bytes of members are being uploaded."""
+
+    def __init__(self, limit):
+        self._limit = limit
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size):
+        with self._condition:
+            # A member bigger than the whole budget is let through on its own
+            self._condition.wait_for(
+                lambda: self._in_flight == 0 or self._in_flight + size <= self._limit
+            )
+            self._in_flight += size
+
+    def release(self, size):
+        with self._condition:
+            self._in_flight -= size
+            self._condition.notify_all()
+
+
+class MemberResult:
+    """Aggregated outcome of running one step over the members of an archive."""
+
+    def __init__(self, on_entry=None):
+        self.entries = {}
+        self.bytes = 0
+        self.retries = 0
+        self.skipped = []
+        self.failed = {}
+        self._on_entry = on_entry
+        self._lock = threading.Lock()
+
+    def add(self, target_path, entry=None, error=None, retries=0):
+        with self._lock:
+            self.retries += retries
+            if error is not None:
+                self.failed[target_path] = error
+            elif entry is None:
+                self.skipped.append(target_path)
+            else:
+                self.entries[target_path] = entry
+                self.bytes += entry["size"]
+        if entry is not None and self._on_entry is not None:
+            self._on_entry(target_path, entry)
+
+    def raise_for_failures(self):
+        if self.failed:
+            path, error = next(iter(self.failed.items()))
+            raise ValueError(
+                f"{len(self.failed)} file(s) failed to upload, first was {path}: {error}"
+            )
+
+
+class _HashingReader:
+    """
+    Wraps a file object and SHA-256 hashes everything read through it.
+
+    Anything read is also written to each of ``sinks``.
+    """
+
+    def __init__(self, fileobj, sinks=()):
+        self._fileobj = fileobj
+        self._sinks = sinks
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
+        for sink in self._sinks:
+            sink.write(data)
+        return data
+
+
+class _CompressedVariant:
+    """Compresses the bytes written to it into a spooled temporary file."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.file = tempfile.SpooledTemporaryFile(max_size=settings.HTML_SITE_SPOOL_MAX_MEMORY)
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=settings.HTML_SITE_BROTLI_QUALITY)
+            self._compress = self._compressor.process
+            self._flush = self._compressor.finish
+        else:
+            # wbits=31 writes a gzip container (with a zero mtime, so output is reproducible)
+            self._compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+            self._compress = self._compressor.compress
+            self._flush = self._compressor.flush
+
+    def write(self, data):
+        self.file.write(self._compress(data))
+
+    def finish(self):
+        """Flush the compressor and rewind; returns the compressed size."""
+        self.file.write(self._flush())
+        size = self.file.tell()
+        self.file.seek(0)
+        return size
+
+
+def _variant_encodings(target_path, size):
+    """Content-Encodings to precompress a member of ``size`` bytes (None if unknown) as, if any."""
+    if not settings.HTML_SITE_PRECOMPRESS:
+        return []
+    if size is not None and size < settings.HTML_SITE_PRECOMPRESS_MIN_SIZE:
+        return []
+
+    content_type = guess_content_type(target_path)
+    if not (content_type.startswith("text/") or content_type in COMPRESSIBLE_CONTENT_TYPES):
+        return []
+
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
 
-def process_html_zip_file_now(media):
+
+def _finished_variants(variants, size):
+    """
+    Finish ``variants`` of a ``size`` byte file, yielding ``(variant, compressed_size)``
+    for the ones that save at least 10%. Each variant's file is closed afterwards.
+    """
+    for variant in variants:
+        with variant.file:
+            compressed_size = variant.finish()
+            if compressed_size <= size * 0.9:
+                yield variant, compressed_size
+
+
+def _store_variants(variants, storage_name, target_path, size):
+    """
+    Upload the finished compressed variants of ``storage_name`` as siblings.
+
+    Returns the manifest ``variants`` mapping of Content-Encoding to storage key
+    and size.
+    """
+    stored = {}
+    for variant, compressed_size in _finished_variants(variants, size):
+        variant_name = storage_name + VARIANT_SUFFIXES[variant.encoding]
+        save_stream(
+            variant_name,
+            variant.file,
+            compressed_size,
+            guess_content_type(target_path),
+            content_encoding=variant.encoding,
+        )
+        stored[variant.encoding] = {"storage_key": variant_name, "size": compressed_size}
+    return stored
+
+
+def _manifest_entry(reader, target_path):
+    sha256 = reader.sha256.hexdigest()
+    return {
+        "sha256": sha256,
+        "size": reader.size,
+        "content_type": guess_content_type(target_path),
+        "encoding": "",
+        "etag": f'"{sha256}"',
+    }
+
+
+def blob_name(sha256, target_path):
+    """Storage name of the content-addressed copy of a file (keeps the extension for CDNs)."""
+    ext = os.path.splitext(target_path)[1].lower()
+    return f"{BLOB_PREFIX}/{sha256[:2]}/{sha256}{ext}"
+
+
+class _LZMAReader:
+    """
+    Decompresses an .xz stream incrementally as it is read.
+
+    Raises lzma.LZMAError once more than ``max_size`` bytes have come out, so a
+    small member can't expand without bound.
+    """
+
+    # Compressed bytes fed to the decompressor at a time
+    INPUT_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, fileobj, max_size):
+        self._fileobj = fileobj
+        self._max_size = max_size
+        self._decompressor = lzma.LZMADecompressor()
+        self.size = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            return b"".join(iter(lambda: self.read(settings.HTML_SITE_CHUNK_SIZE), b""))
+
+        while not self._decompressor.eof:
+            data = b""
+            if self._decompressor.needs_input:
+                data = self._fileobj.read(self.INPUT_CHUNK_SIZE)
+                if not data:
+                    raise lzma.LZMAError("Compressed data ended before the end-of-stream marker")
+
+            output = self._decompressor.decompress(data, max_length=size)
+            if output:
+                self.size += len(output)
+                if self.size > self._max_size:
+                    raise lzma.LZMAError(f"Decompressed data exceeds {self._max_size} bytes")
+                return output
+        return b""
+
+
+@contextmanager
+def _open_member(zip_ref, file_info):
+    """
+    Yield ``(reader, size)`` for a zip member, decompressing Verge3D .xz members.
+
+    .xz members are decompressed while they are read, so their size is None.
+    """
+    with zip_ref.open(file_info) as source_file:
+        if file_info.filename.endswith(".xz"):
+            yield _LZMAReader(source_file, settings.HTML_SITE_MAX_XZ_MEMBER_BYTES), None
+        else:
+            yield source_file, file_info.file_size
+
+
+def _copy_member(zip_ref, file_info, target_path, storage_name):
+    """
+    Copy one zip member to ``storage_name`` and return its manifest entry.
+
+    Compressible members are gzip/brotli compressed while they are copied and
+    the results are stored next to them (``.gz``/``.br``).
+    """
+    with _open_member(zip_ref, file_info) as (source, size):
+        variants = [_CompressedVariant(encoding) for encoding in _variant_encodings(target_path, size)]
+        reader = _HashingReader(source, sinks=variants)
+        save_stream(storage_name, reader, size, guess_content_type(target_path))
+
+    entry = dict(_manifest_entry(reader, target_path), storage_key=storage_name)
+    entry["variants"] = _store_variants(variants, storage_name, target_path, reader.size)
+    return entry
+
+
+def _hash_member(zip_ref, file_info, target_path, storage_name):
+    """Hash one zip member without storing it."""
+    with _open_member(zip_ref, file_info) as (source, _size):
+        reader = _HashingReader(source)
+        while reader.read(settings.HTML_SITE_CHUNK_SIZE):
+            pass
+
+    return _manifest_entry(reader, target_path)
+
+
+def _run_with_retries(func, zip_ref, file_info, target_path, storage_name, result):
+    retries = settings.HTML_SITE_UPLOAD_RETRIES
+    for attempt in range(retries + 1):
+        try:
+            entry = func(zip_ref, file_info, target_path, storage_name)
+        except lzma.LZMAError as e:
+            # Corrupt .xz members are skipped, retrying won't help
+            logger.error(f"Failed to decompress {file_info.filename}: {e}")
+            result.add(target_path, retries=attempt)
+            return
+        except Exception as e:
+            if attempt == retries:
+                logger.error(f"Giving up on {target_path} after {attempt + 1} attempts: {e}")
+                result.add(target_path, error=str(e), retries=attempt)
+                return
+            logger.warning(f"Processing {target_path} failed (attempt {attempt + 1}): {e}")
+            time.sleep(0.5 * 2 ** attempt)
+        else:
+            result.add(target_path, entry=entry, retries=attempt)
+            return
+
+
+def map_members(zip_ref, jobs, func, on_entry=None, progress=None):
+    """
+    Run ``func`` over ``(file_info, target_path, storage_name)`` jobs with a thread pool.
+
+    Up to HTML_SITE_UPLOAD_WORKERS members are processed at once, and new members
+    are only queued while less than HTML_SITE_UPLOAD_MAX_INFLIGHT_BYTES are in
+    flight. Each member is retried on its own; the returned MemberResult covers
+    the whole archive. ``on_entry(target_path, entry)`` is called, from the
+    worker threads, as each member succeeds, and each finished member is counted
+    in ``progress`` (an ExtractionProgress).
+    """
+    result = MemberResult(on_entry)
+    budget = _ByteBudget(settings.HTML_SITE_UPLOAD_MAX_INFLIGHT_BYTES)
+
+    def done(size):
+        budget.release(size)
+        if progress is not None:
+            progress.advance(size)
+
+    with ThreadPoolExecutor(
+        max_workers=settings.HTML_SITE_UPLOAD_WORKERS,
+        thread_name_prefix="html-site-upload",
+    ) as executor:
+        for file_info, target_path, storage_name in jobs:
+            size = file_info.file_size
+            budget.acquire(size)
+            future = executor.submit(
+                _run_with_retries, func, zip_ref, file_info, target_path, storage_name, result
+            )
+            future.add_done_callback(lambda _f, size=size: done(size))
+
+    return result
+
+
+class _Checkpoint:
+    """
+    Manifest entries of the members an extraction has already stored, kept in a
+    Redis hash so that a retry after a crash can skip them.
+
+    The hash records which ZIP it belongs to; entries for a different upload of
+    the same media are discarded. Without Redis, extractions start over.
+    """
+
+    TTL = 7 * 24 * 60 * 60
+    ARCHIVE_FIELD = "__archive__"
+
+    def __init__(self, media, required=False):
+        self.key = f"media_library:html_checkpoint:{media.id}"
+        self._archive = media.file.name
+        # Sharded extractions hand their results over through the checkpoint, so
+        # for them Redis errors are raised instead of ignored
+        self._required = required
+        self._enabled = required or bool(settings.REDIS_URL)
+
+    def _redis(self):
+        from .cache import redis_client
+
+        return redis_client()
+
+    def _disable(self, e):
+        if self._required:
+            raise e
+        logger.warning(f"HTML extraction checkpoint {self.key} unavailable: {e}")
+        self._enabled = False
+
+    def load(self):
+        """Return the checkpointed entries by target path, starting a new checkpoint if none apply."""
+        if not self._enabled:
+            return {}
+        try:
+            stored = self._redis().hgetall(self.key)
+            if stored.get(self.ARCHIVE_FIELD.encode()) == self._archive.encode():
+                return {
+                    field.decode(): json.loads(value)
+                    for field, value in stored.items()
+                    if field.decode() != self.ARCHIVE_FIELD
+                }
+            with self._redis().pipeline() as pipe:
+                pipe.delete(self.key)
+                pipe.hset(self.key, self.ARCHIVE_FIELD, self._archive)
+                pipe.expire(self.key, self.TTL)
+                pipe.execute()
+        except Exception as e:
+            self._disable(e)
+        return {}
+
+    def add(self, target_path, entry):
+        if not self._enabled:
+            return
+        try:
+            self._redis().hset(self.key, target_path, json.dumps(entry))
+        except Exception as e:
+            self._disable(e)
+
+    def clear(self):
+        if not self._enabled:
+            return
+        try:
+            self._redis().delete(self.key)
+        except Exception as e:
+            self._disable(e)
+
+
+def _verified_entries(entries, stored_sizes):
+    """The checkpointed ``entries`` whose objects (and variants) are stored at the recorded size."""
+    verified = {}
+    for target_path, entry in entries.items():
+        objects = [(entry["storage_key"], entry["size"])]
+        objects += [(variant["storage_key"], variant["size"]) for variant in entry["variants"].values()]
+        if all(stored_sizes.get(name) == size for name, size in objects):
+            verified[target_path] = entry
+    return verified
+
+
+def _in_batches(items, size=500):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _referenced_keys(names):
+    """
+    Return which of the storage ``names`` are used by any site manifest, mapped
+    to the precompressed variants stored for them.
+    """
+    from .models import HTMLSiteAsset
+
+    referenced = {}
+    for batch in _in_batches(names):
+        referenced.update(
+            HTMLSiteAsset.objects.filter(storage_key__in=batch).values_list("storage_key", "variants")
+        )
+    return referenced
+
+
+def _store_blobs(zip_ref, jobs, progress):
+    """
+    Store members content-addressed under html_blobs/.
+
+    Every member is hashed first; only blobs that no manifest references yet are
+    uploaded, once each. Returns the hash-phase result (holding a manifest entry
+    for every member) and the upload-phase result.
+    """
+    hashed = map_members(zip_ref, jobs, _hash_member)
+    hashed.raise_for_failures()
+
+    for target_path, entry in hashed.entries.items():
+        entry["storage_key"] = blob_name(entry["sha256"], target_path)
+
+    known = _referenced_keys({entry["storage_key"] for entry in hashed.entries.values()})
+
+    uploads = {}
+    for file_info, target_path, _storage_name in jobs:
+        entry = hashed.entries.get(target_path)
+        if entry and entry["storage_key"] not in known:
+            uploads.setdefault(entry["storage_key"], (file_info, target_path, entry["storage_key"]))
+
+    # Members whose blob is already stored count as done
+    total_size = sum(job[0].file_size for job in jobs)
+    progress.start(
+        len(jobs),
+        total_size,
+        members_done=len(jobs) - len(uploads),
+        bytes_done=total_size - sum(job[0].file_size for job in uploads.values()),
+    )
+    uploaded = map_members(zip_ref, uploads.values(), _copy_member, progress=progress)
+    uploaded.raise_for_failures()
+    hashed.retries += uploaded.retries
+
+    # Every path shares the variants of the blob it points at
+    new_variants = {entry["storage_key"]: entry["variants"] for entry in uploaded.entries.values()}
+    for entry in hashed.entries.values():
+        key = entry["storage_key"]
+        entry["variants"] = known[key] if key in known else new_variants[key]
+    return hashed, uploaded
+
+
+def _write_zip_member(out_zip, name, source, size, date_time):
+    """Append ``source`` (``size`` bytes, None if unknown) to ``out_zip`` uncompressed; returns where it starts."""
+    info = zipfile.ZipInfo(name, date_time=date_time)
+    info.compress_type = zipfile.ZIP_STORED
+    # A member of unknown size might need the Zip64 header, which has to be chosen up front
+    force_zip64 = size is None or size >= zipfile.ZIP64_LIMIT
+    with out_zip.open(info, "w", force_zip64=force_zip64) as dest:
+        # The local header has been written, the data follows it
+        offset = out_zip.fp.tell()
+        while chunk := source.read(settings.HTML_SITE_CHUNK_SIZE):
+            dest.write(chunk)
+    return offset
+
+
+def _store_zip(zip_ref, jobs, extract_base, progress):
+    """
+    Repack the site into one store-only zip under ``extract_base`` and upload it.
+
+    Members are written uncompressed (Verge3D .xz members decompressed), followed
+    by their precompressed variants, so any file can be served with a single
+    ranged read of the zip. Manifest entries record the offset of each file.
+    """
+    result = MemberResult()
+    progress.start(len(jobs), sum(job[0].file_size for job in jobs))
+
+    with tempfile.SpooledTemporaryFile(max_size=settings.HTML_SITE_SPOOL_MAX_MEMORY) as out:
+        with zipfile.ZipFile(out, "w", zipfile.ZIP_STORED, allowZip64=True) as out_zip:
+            for file_info, target_path, _storage_name in jobs:
+                name = os.path.relpath(target_path, extract_base)
+                try:
+                    with _open_member(zip_ref, file_info) as (source, size):
+                        variants = [_CompressedVariant(encoding) for encoding in _variant_encodings(target_path, size)]
+                        reader = _HashingReader(source, sinks=variants)
+                        offset = _write_zip_member(out_zip, name, reader, size, file_info.date_time)
+                except lzma.LZMAError as e:
+                    logger.error(f"Failed to decompress {file_info.filename}: {e}")
+                    result.add(target_path)
+                    progress.advance(file_info.file_size)
+                    continue
+
+                entry = dict(_manifest_entry(reader, target_path), offset=offset, variants={})
+                for variant, compressed_size in _finished_variants(variants, reader.size):
+                    entry["variants"][variant.encoding] = {
+                        "size": compressed_size,
+                        "offset": _write_zip_member(
+                            out_zip,
+                            name + VARIANT_SUFFIXES[variant.encoding],
+                            variant.file,
+                            compressed_size,
+                            file_info.date_time,
+                        ),
+                    }
+                result.add(target_path, entry=entry)
+                progress.advance(file_info.file_size)
+
+        # Named after its contents, so a cached copy of the zip is never stale
+        digest = hashlib.sha256()
+        for target_path, entry in sorted(result.entries.items()):
+            digest.update(f"{target_path}\0{entry['sha256']}\0".encode())
+        zip_name = f"{extract_base}/site-{digest.hexdigest()[:16]}.zip"
+
+        size = out.seek(0, os.SEEK_END)
+        out.seek(0)
+        save_stream(zip_name, out, size, "application/zip")
+
+    for entry in result.entries.values():
+        entry["storage_key"] = zip_name
+        for variant in entry["variants"].values():
+            variant["storage_key"] = zip_name
+    return result
+
+
+def _save_manifest(media, entries, version):
+    """
+    Store the manifest of extraction ``version`` of ``media``, replacing any an
+    earlier attempt at that version left; returns the storage names it no
+    longer uses. The manifests of other versions are left alone, so they can be
+    served until collected.
+    """
+    from .models import HTMLSiteAsset
+
+    with transaction.atomic():
+        rows = media.html_assets.filter(version=version)
+        previous = set(rows.values_list("storage_key", flat=True))
+        rows.delete()
+        HTMLSiteAsset.objects.bulk_create(
+            [HTMLSiteAsset(media=media, version=version, path=path, **entry) for path, entry in entries.items()],
+            batch_size=500,
+        )
+        # Workers serving the old manifest must stop before its files are deleted
+        from .cache import invalidate_site
+        transaction.on_commit(lambda: invalidate_site(media.id))
+
+    return previous - {entry["storage_key"] for entry in entries.values()}
+
+
+def _with_variant_names(names):
+    """``names`` plus the storage names their precompressed variants would have."""
+    return set(names) | {name + suffix for name in names for suffix in VARIANT_SUFFIXES.values()}
+
+
+def _lock_reused_blobs(names):
+    """
+    Lock the manifest rows that keep the blobs ``names`` (reused by an extraction
+    rather than uploaded) alive until the current transaction commits, so none
+    of them can be dropped before the new manifest references the blobs too.
+
+    Raises RuntimeError if some blob lost its last reference since the
+    extraction found it, as it may have been deleted; the retry uploads it.
+    """
+    from .models import HTMLSiteAsset
+
+    locked = set()
+    for batch in _in_batches(sorted(names)):
+        locked.update(
+            HTMLSiteAsset.objects.select_for_update()
+            .filter(storage_key__in=batch)
+            .order_by("id")
+            .values_list("storage_key", flat=True)
+        )
+    lost = set(names) - locked
+    if lost:
+        raise RuntimeError(f"{len(lost)} reused HTML site blobs lost their last reference during extraction")
+
+
+def _stored_since(name, timestamp):
+    """Whether storage object ``name`` was written after ``timestamp`` (False if it doesn't exist)."""
+    try:
+        return default_storage.get_modified_time(name).timestamp() > timestamp
+    except Exception:
+        return False
+
+
+def delete_unreferenced_blobs(names):
+    """
+    Delete the html_blobs/ objects among ``names`` that no site manifest uses any more.
+
+    Blobs written less than HTML_SITE_PROCESSING_TIMEOUT ago may have just been
+    uploaded by an extraction that hasn't saved its manifest yet; they are
+    checked again once that has passed (tasks.delete_html_blobs).
+    """
+    names = {name for name in names if name.startswith(f"{BLOB_PREFIX}/")}
+    orphans = names - _referenced_keys(names).keys()
+    cutoff = time.time() - settings.HTML_SITE_PROCESSING_TIMEOUT
+    recent = {name for name in orphans if _stored_since(name, cutoff)}
+    if recent:
+        from .tasks import delete_html_blobs
+
+        delete_html_blobs.send_with_options(
+            args=(sorted(recent),), delay=settings.HTML_SITE_PROCESSING_TIMEOUT * 1000
+        )
+    orphans -= recent
+    if orphans:
+        # Deleting a variant that was never stored is a no-op
+        delete_names(_with_variant_names(orphans))
+        logger.info(f"Deleted {len(orphans)} unreferenced HTML site blobs")
+
+
+def _extraction_base(media):
+    """
+    Storage prefix the next extraction of ``media`` is written under: a version of
+    its own, so nothing the live version serves ever changes in place. The name of
+    the ZIP is part of it, so a run still busy with a replaced upload never writes
+    (or deletes) the files of the run extracting the new one.
+    """
+    token = hashlib.sha1(media.file.name.encode()).hexdigest()[:8]
+    return f"html_sites/{media.id}/v{media.html_version + 1}-{token}"
+
+
+def delete_old_site_versions(media_id, live_version, live_base_dir):
+    """
+    Delete the manifests and files of ``media_id`` stored by extractions older than
+    ``live_version``, including those of the unversioned layout and of runs that
+    lost to the one serving ``live_base_dir``. Newer versions (an extraction in
+    progress) are left alone.
+    """
+    from .cache import invalidate_site
+    from .models import HTMLSiteAsset
+
+    old_rows = HTMLSiteAsset.objects.filter(media_id=media_id, version__lt=live_version)
+    old_keys = set(old_rows.values_list("storage_key", flat=True))
+    if old_keys:
+        old_rows.delete()
+        invalidate_site(media_id)
+        # Shared blobs the old versions used, unless other manifests still do
+        delete_unreferenced_blobs(old_keys)
+
+    prefix = f"html_sites/{media_id}"
+    live_dir = live_base_dir[len(prefix) + 1:].split("/", 1)[0]
+    old = set()
+    for name in list_prefix(prefix):
+        version_dir = name[len(prefix) + 1:].split("/", 1)[0]
+        match = re.fullmatch(r"v(\d+)(?:-\w+)?", version_dir)
+        if version_dir != live_dir and (match is None or int(match[1]) <= live_version):
+            old.add(name)
+    if old:
+        delete_names(old)
+        logger.info(f"Deleted {len(old)} files of old versions of media {media_id}")
+
+
+def _member_target(extract_base, filename):
+    """
+    Storage path member ``filename`` is extracted to under ``extract_base``.
+
+    Raises InvalidArchive for names that would land outside it (absolute paths,
+    drive letters, "../" segments), which could overwrite other sites' files.
+    """
+    if filename.startswith(("/", "\\")) or ntpath.splitdrive(filename)[0]:
+        raise InvalidArchive(f"ZIP member has an absolute path: {filename}")
+    target_path = os.path.normpath(os.path.join(extract_base, filename))
+    if target_path == extract_base or os.path.commonpath([extract_base, target_path]) != extract_base:
+        raise InvalidArchive(f"ZIP member would be extracted outside the site: {filename}")
+    return target_path
+
+
+def _member_jobs(zip_ref, extract_base):
+    """
+    Return ``(members, jobs, index_path)`` for the files in ``zip_ref``: the jobs are
+    ``(file_info, target_path, storage_name)`` and ``index_path`` is the target path
+    of the shallowest index.html (None if there is none).
+
+    Raises InvalidArchive if any member would be extracted outside ``extract_base``.
+    """
+    members = [info for info in zip_ref.infolist() if not info.is_dir()]
+    index_path = None
+    jobs = []
+    for file_info in members:
+        filename = file_info.filename
+
+        # Verge3D .xz members are stored decompressed under their real name
+        if filename.endswith(".xz"):
+            filename = filename[:-3]  # Remove .xz extension
+
+        # Construct the target path in storage
+        target_path = _member_target(extract_base, filename)
+        jobs.append((file_info, target_path, target_path))
+
+        # Identify index.html
+        if filename.endswith("index.html"):
+            # The first index.html found (or highest in hierarchy)
+            if index_path is None or len(filename) < len(index_path):
+                index_path = target_path
+    return members, jobs, index_path
+
+
+def plan_html_zip_shards(media):
+    """
+    Split the extraction of a large HTML site into batches of member names of about
+    HTML_SITE_SHARD_BATCH_BYTES (uncompressed) each, or return None if the site
+    should be extracted in one go.
+
+    Only files mode is sharded, and only archives of at least HTML_SITE_SHARD_MIN_BYTES.
+    Members an earlier attempt already stored are left out, so the result may be empty.
+    """
+    from .models import HTMLStorageMode, ProcessingStatus
+
+    if not settings.HTML_SITE_SHARD_MIN_BYTES or settings.HTML_SITE_STORAGE_MODE != HTMLStorageMode.FILES:
+        return None
+    if not media.is_html or media.processing_status != ProcessingStatus.PROCESSING:
+        return None
+
+    extract_base = _extraction_base(media)
+    with open_media_file_seekable(media, ranged=True) as archive, zipfile.ZipFile(archive, "r") as zip_ref:
+        members, jobs, _ = _member_jobs(zip_ref, extract_base)
+    _check_archive_limits(members)
+    total_size = sum(info.file_size for info in members)
+    if total_size < settings.HTML_SITE_SHARD_MIN_BYTES:
+        return None
+
+    # Also starts the checkpoint the shards record their members in
+    checkpoint = _Checkpoint(media, required=True)
+    resumed = _verified_entries(checkpoint.load(), list_prefix_sizes(extract_base))
+    pending = [job for job in jobs if job[1] not in resumed]
+    pending_size = sum(job[0].file_size for job in pending)
+    ExtractionProgress(media.id).start(
+        len(jobs), total_size, members_done=len(jobs) - len(pending), bytes_done=total_size - pending_size
+    )
+    count = min(len(pending), -(-pending_size // settings.HTML_SITE_SHARD_BATCH_BYTES) or 1)
+
+    # Largest member first into the lightest batch keeps the batches within one
+    # member of each other
+    batches = [(0, i, []) for i in range(count)]
+    for file_info, _, _ in sorted(pending, key=lambda job: job[0].file_size, reverse=True):
+        size, i, names = heapq.heappop(batches)
+        names.append(file_info.filename)
+        heapq.heappush(batches, (size + file_info.file_size, i, names))
+    logger.info(
+        f"Sharding media {media.id}: {len(pending)} files, {pending_size} bytes in {count} batches "
+        f"({len(resumed)} files already stored)"
+    )
+    return [names for _, _, names in sorted(batches, key=lambda batch: batch[1])]
+
+
+def store_html_zip_members(media, filenames):
+    """
+    Copy the members ``filenames`` of a sharded extraction to storage, recording
+    each in the extraction's checkpoint for process_html_zip_file_now to pick up.
+    """
+    extract_base = _extraction_base(media)
+    wanted = set(filenames)
+    checkpoint = _Checkpoint(media, required=True)
+    # Members this batch stored before being retried
+    done = checkpoint.load()
+
+    with open_media_file_seekable(media, ranged=True) as archive, zipfile.ZipFile(archive, "r") as zip_ref:
+        _, jobs, _ = _member_jobs(zip_ref, extract_base)
+        jobs = [job for job in jobs if job[0].filename in wanted and job[1] not in done]
+        progress = ExtractionProgress(media.id)
+        result = map_members(zip_ref, jobs, _copy_member, on_entry=checkpoint.add, progress=progress)
+        progress.flush()
+
+    logger.info(
+        f"Stored batch of {len(jobs)} files for media {media.id} ({result.bytes} bytes), "
+        f"{result.retries} retries, {len(result.skipped)} skipped, {len(result.failed)} failed"
+    )
+    result.raise_for_failures()
+
+
+def process_html_zip_file_now(media, ranged=False):
     """
     Extracts HTML zip files into storage and identifies the index.html path.
     Handles Verge3D .xz compression by renaming and setting S3 metadata.
+
+    The archive is read from a seekable local/spooled copy and every member is
+    streamed to storage in HTML_SITE_CHUNK_SIZE chunks, so memory use does not
+    grow with the size of the archive. Members are uploaded in parallel (or, in
+    zip mode, repacked into a single object), and a manifest (HTMLSiteAsset rows)
+    records where each file's bytes are stored.
+
+    With ``ranged`` the archive is read on demand instead of downloaded; this is
+    how the last step of a sharded extraction, which has the members stored
+    already, avoids fetching all of it.
     """
-    from django.core.files.storage import default_storage
-    import io
-    import mimetypes
+    from .models import HTMLStorageMode, MediaFile, ProcessingStatus
 
-    # Skip if not an HTML zip or already processed
-    if not media.is_html or media.html_index_path:
+    # Skip if not an HTML zip or not claimed for processing (see MediaFile.claim_processing)
+    if not media.is_html or media.processing_status != ProcessingStatus.PROCESSING:
         return
 
     logger.info(f"Processing HTML ZIP for media {media.id}")
+    progress = ExtractionProgress(media.id)
 
     try:
-        # Get the zip file content
-        with media.file.open("rb") as f:
-            zip_content = f.read()
+        started = time.monotonic()
+        storage_mode = settings.HTML_SITE_STORAGE_MODE
 
-        # Open the ZIP file from memory
-        with zipfile.ZipFile(io.BytesIO(zip_content), "r") as zip_ref:
+        progress.phase(PHASE_DOWNLOADING)
+        with open_media_file_seekable(media, ranged) as archive, zipfile.ZipFile(archive, "r") as zip_ref:
             # Create extraction directory prefix
-            extract_base = f"html_sites/{media.id}"
+            extract_base = _extraction_base(media)
 
-            index_path = None
             base_dir = None
 
-            # Iterate through all files in the ZIP
-            for file_info in zip_ref.infolist():
-                if file_info.is_dir():
-                    continue
+            members, jobs, index_path = _member_jobs(zip_ref, extract_base)
+            _check_archive_limits(members)
+            if index_path:
+                base_dir = os.path.dirname(index_path)
 
-                filename = file_info.filename
-                is_compressed = False
-
-                # Verge3D Fallback: If it ends in .xz, it's LZMA compressed
-                if filename.endswith(".xz"):
-                    filename = filename[:-3]  # Remove .xz extension
-                    is_compressed = True
-
-                # Construct the target path in storage
-                target_path = os.path.join(extract_base, filename)
-
-                # Save the file to storage
-                with zip_ref.open(file_info) as source_file:
-                    if default_storage.exists(target_path):
-                        default_storage.delete(target_path)
-
-                    content = source_file.read()
-
-                    # Decompress .xz files with LZMA
-                    if is_compressed:
-                        import lzma
-
-                        try:
-                            content = lzma.decompress(content)
-                        except lzma.LZMAError as e:
-                            logger.error(f"Failed to decompress {filename}: {e}")
-                            continue
-
-                    # Upload with correct Content-Type via boto3 if on S3
-                    if hasattr(default_storage, "bucket"):
-                        content_type, _ = mimetypes.guess_type(target_path)
-                        # Ensure .js files get the right type
-                        ext = os.path.splitext(target_path)[1].lower()
-                        if ext == ".js":
-                            content_type = "application/javascript"
-                        elif ext == ".wasm":
-                            content_type = "application/wasm"
-                        elif ext == ".gltf":
-                            content_type = "model/gltf+json"
-                        elif ext == ".css":
-                            content_type = "text/css"
-                        content_type = content_type or "application/octet-stream"
-
-                        default_storage.bucket.put_object(
-                            Key=target_path,
-                            Body=content,
-                            ContentType=content_type,
-                        )
-                    else:
-                        from django.core.files.base import ContentFile
-
-                        default_storage.save(target_path, ContentFile(content))
-
-                # Identify index.html
-                if filename.endswith("index.html"):
-                    # The first index.html found (or highest in hierarchy)
-                    if index_path is None or len(filename) < len(index_path):
-                        index_path = target_path
-                        base_dir = os.path.dirname(target_path)
-
-        # Update media file with paths
-        if index_path:
-            media.html_index_path = index_path
-            media.html_base_dir = base_dir
-            media.is_processed = True
-            logger.info(f"Successfully processed HTML site: index={index_path}")
-            return media
-        else:
+            # One listing up front instead of exists()/delete() per member
+            existing_sizes = list_prefix_sizes(extract_base)
+            existing = set(existing_sizes)
+
+            checkpoint = None
+            if storage_mode == HTMLStorageMode.BLOBS:
+                result, uploaded = _store_blobs(zip_ref, jobs, progress)
+            elif storage_mode == HTMLStorageMode.ZIP:
+                result = uploaded = _store_zip(zip_ref, jobs, extract_base, progress)
+            else:
+                # Resume an interrupted run: members it stored, and that are still
+                # there intact, aren't copied again
+                checkpoint = _Checkpoint(media)
+                resumed = _verified_entries(checkpoint.load(), existing_sizes)
+                if resumed:
+                    logger.info(f"Resuming media {media.id}: {len(resumed)} files already stored")
+                pending = [job for job in jobs if job[1] not in resumed]
+                total_size = sum(job[0].file_size for job in jobs)
+                progress.start(
+                    len(jobs),
+                    total_size,
+                    members_done=len(jobs) - len(pending),
+                    bytes_done=total_size - sum(job[0].file_size for job in pending),
+                )
+                result = uploaded = map_members(
+                    zip_ref, pending, _copy_member, on_entry=checkpoint.add, progress=progress
+                )
+                result.entries.update(resumed)
+
+        logger.info(
+            f"Stored {len(result.entries)} files for media {media.id} "
+            f"({len(uploaded.entries)} uploaded, {uploaded.bytes} bytes) "
+            f"in {time.monotonic() - started:.1f}s, {result.retries} retries, "
+            f"{len(result.skipped)} skipped, {len(result.failed)} failed"
+        )
+        result.raise_for_failures()
+
+        if not index_path:
             logger.error(f"No index.html found in ZIP for media {media.id}")
             media.processing_error = "No index.html found in ZIP file"
+            media.processing_status = ProcessingStatus.FAILED
+            if media.save_processing_result(media.html_version):
+                progress.set_status(media.processing_status, media.processing_error)
+            return media
+
+        progress.phase(PHASE_FINALIZING)
+        from_version = media.html_version
+        media.html_index_path = index_path
+        media.html_base_dir = base_dir
+        media.html_storage_mode = storage_mode
+        media.html_version += 1
+        media.processing_status = ProcessingStatus.READY
+        media.processing_error = ""
+        media.is_processed = True
+        with transaction.atomic():
+            # The manifest goes live with the row, and only if this run still owns it
+            saved = media.save_processing_result(from_version)
+            if saved:
+                if storage_mode == HTMLStorageMode.BLOBS:
+                    _lock_reused_blobs(
+                        {entry["storage_key"] for entry in result.entries.values()}
+                        - {entry["storage_key"] for entry in uploaded.entries.values()}
+                    )
+                dropped = _save_manifest(media, result.entries, media.html_version)
+        if not saved:
+            # What this run stored is of no use, unless a run of the same ZIP won
+            # and serves these very files
+            live_base_dir = MediaFile.objects.filter(pk=media.pk).values_list("html_base_dir", flat=True).first()
+            if not f"{live_base_dir}/".startswith(f"{extract_base}/"):
+                delete_names(list_prefix(extract_base))
+            delete_unreferenced_blobs({entry["storage_key"] for entry in result.entries.values()})
+            raise ProcessingSuperseded(f"Media {media.id} changed while {media.file.name} was being processed")
+
+        # Drop files an interrupted attempt at this version left behind; earlier
+        # versions are deleted later (tasks.collect_html_site_versions)
+        written = set()
+        for entry in result.entries.values():
+            written.add(entry["storage_key"])
+            written.update(variant["storage_key"] for variant in entry["variants"].values())
+        stale = existing - written
+        if stale:
+            delete_names(stale)
+            logger.info(f"Deleted {len(stale)} stale files for media {media.id}")
+        delete_unreferenced_blobs(dropped)
+        if checkpoint is not None:
+            checkpoint.clear()
 
+        progress.set_status(media.processing_status)
+        logger.info(f"Successfully processed HTML site: index={index_path}")
+        return media
+
+    except ProcessingSuperseded:
+        raise
     except Exception as e:
         logger.error(f"Error processing HTML ZIP for media {media.id}: {e}")
         media.processing_error = str(e)
+        media.processing_status = ProcessingStatus.FAILED
+        progress.set_status(media.processing_status, media.processing_error)
         raise
-
-    return media
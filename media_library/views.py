@@ -1,17 +1,46 @@
 # media_library/views.py
+import io
+import lzma
 import mimetypes
 import os
+import re
+from urllib.parse import quote
 
 from django.conf import settings
-from django.http import FileResponse, Http404
+from django.http import (
+    FileResponse, Http404, HttpResponse, HttpResponseForbidden, HttpResponseRedirect, StreamingHttpResponse
+)
 from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.core.paginator import Paginator
-from django.db.models import Q
-
-from .models import MediaFile, MediaCategory
+from django.db.models import F, Q
+from django.utils.cache import get_conditional_response
+from django.utils.crypto import constant_time_compare
+from django.utils.http import http_date
+
+from .cache import (
+    cache_asset,
+    cacheable_asset_size,
+    get_cached_asset,
+    get_site_asset,
+    get_site_route,
+    get_version_base_dir,
+)
+from .models import HTMLStorageMode, ImageVariant, MediaFile, MediaCategory, ProcessingStatus
 from .forms import MediaFileForm
+from .renditions import (
+    VARIANT_AUTO,
+    VARIANT_FORMATS,
+    check_variant,
+    get_or_render_variant,
+    source_version,
+    variant_format,
+    variant_signature,
+    variant_url,
+)
+from .storage import open_stream
 from .tasks import logger
 
 
@@ -79,7 +108,10 @@ def media_upload(request):
 def media_detail(request, pk):
     media_file = get_object_or_404(MediaFile, pk=pk)
     # Check if HTML file is still processing
-    processing = media_file.is_html and not media_file.html_index_path
+    processing = media_file.is_html and media_file.processing_status in (
+        ProcessingStatus.PENDING,
+        ProcessingStatus.PROCESSING,
+    )
     return render(
         request,
         "media_library/media_detail.html",
@@ -144,79 +176,458 @@ def media_category(request, slug):
     )
 
 
+def _decompressed_chunks(xz_file):
+    """Yield the decompressed bytes of ``xz_file`` in chunks, closing it when done."""
+    with xz_file, lzma.open(xz_file) as file_obj:
+        while chunk := file_obj.read(settings.HTML_SITE_CHUNK_SIZE):
+            yield chunk
+
+
+def _serve_legacy_html_file(relative_path):
+    """Serve a file of a site that has no manifest by probing storage."""
+    from django.core.files.storage import default_storage
+
+    # Determine the content type
+    content_type, _ = mimetypes.guess_type(relative_path)
+    content_type = content_type or "application/octet-stream"
+
+    try:
+        # Create a response with the file content from storage
+        # We skip .exists() to reduce S3 latency (1 call instead of 2)
+        try:
+            # Try original path first
+            file_obj = default_storage.open(relative_path, "rb")
+            response = FileResponse(file_obj, content_type=content_type)
+        except Exception:
+            # Verge3D Fallback: Check if a compressed (.xz) version exists
+            # This handles files that were uploaded before the new renaming logic
+            # Browsers can't decode "Content-Encoding: xz", so decompress while streaming
+            if not relative_path.endswith(".xz"):
+                xz_path = relative_path + ".xz"
+                # Streamed without a Content-Length: FileResponse would seek to the
+                # end to size it, decompressing the whole file an extra time
+                response = StreamingHttpResponse(
+                    _decompressed_chunks(default_storage.open(xz_path, "rb")), content_type=content_type
+                )
+            else:
+                raise
+    except Exception:
+        # If the file doesn't exist or S3 fails
+        raise Http404("File not found")
+
+    return response, content_type
+
+
+def _accepted_encodings(request):
+    """Content-Encodings the client accepts (q > 0), from its Accept-Encoding header."""
+    accepted = set()
+    for part in request.headers.get("Accept-Encoding", "").split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip().lower()
+        params = params.strip().replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding)
+    return accepted
+
+
+def _pick_variant(asset, accepted):
+    """Return ``(encoding, variant)`` for the best precompressed copy the client accepts."""
+    for encoding in ("br", "gzip"):
+        variant = asset.variants.get(encoding)
+        if variant and (encoding in accepted or "*" in accepted):
+            return encoding, variant
+    return None, None
+
+
+class _UnsatisfiableRange(Exception):
+    pass
+
+
+def _parse_range(header, size):
+    """
+    Parse a ``Range: bytes=...`` header for a body of ``size`` bytes.
+
+    Returns the inclusive ``(start, end)`` to serve, or None when the header is
+    absent, malformed or asks for several ranges (the full body is served then).
+    Raises _UnsatisfiableRange when the range lies outside the body.
+    """
+    if not header or not header.startswith("bytes="):
+        return None
+
+    spec = header[len("bytes="):].strip()
+    if "," in spec:
+        return None
+
+    first, separator, last = spec.partition("-")
+    if not separator:
+        return None
+
+    try:
+        if not first:
+            # Suffix range: the last N bytes
+            suffix = int(last)
+            if suffix <= 0 or size == 0:
+                raise _UnsatisfiableRange
+            return max(size - suffix, 0), size - 1
+
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+
+    if start < 0 or (last and end < start):
+        return None
+    if start >= size:
+        raise _UnsatisfiableRange
+    return start, min(end, size - 1)
+
+
+def _offload_response(stored_name, delivery):
+    """
+    Response that hands the body of ``stored_name`` to nginx or the CDN.
+
+    Range requests are left to whoever ends up sending the bytes.
+    """
+    from django.core.files.storage import default_storage
+
+    if delivery == "accel":
+        response = HttpResponse()
+        response["X-Accel-Redirect"] = settings.HTML_SITE_ACCEL_PREFIX.rstrip("/") + "/" + quote(stored_name)
+        return response
+    if delivery == "redirect":
+        return HttpResponseRedirect(default_storage.url(stored_name))
+    raise ValueError(f"Unknown HTML_SITE_DELIVERY: {delivery}")
+
+
+def _open_asset_body(stored_name, offset, size, etag, start=None, end=None):
+    """
+    Open the stored bytes of a manifest file, or the inclusive ``start``-``end`` range.
+
+    Members of a site zip (``offset`` set) are always read by range.
+    """
+    if offset is None:
+        return open_stream(stored_name, start, end, version=etag)
+    if start is None:
+        start, end = 0, size - 1
+    if end < start:
+        return io.BytesIO()
+    # The zip's name changes with its contents, so it needs no version
+    return open_stream(stored_name, offset + start, offset + end)
+
+
+def _read_cached_asset(asset, stored_name, offset, etag, size):
+    """
+    Bytes of ``stored_name`` from the hot-asset cache, filling it on a miss.
+
+    Returns None for files too big to cache, which are streamed instead.
+    """
+    cache_name = stored_name if offset is None else f"{stored_name}@{offset}"
+    data = get_cached_asset(asset.media_id, cache_name, etag)
+    if data is not None or not cacheable_asset_size(size):
+        return data
+
+    try:
+        file_obj = _open_asset_body(stored_name, offset, size, etag)
+        try:
+            data = file_obj.read()
+        finally:
+            file_obj.close()
+    except Exception as e:
+        logger.error(f"Manifest entry {stored_name} could not be read: {e}")
+        raise Http404("File not found")
+
+    if len(data) != size:
+        logger.error(f"Manifest entry {stored_name} is {len(data)} bytes, expected {size}")
+        raise Http404("File not found")
+
+    cache_asset(asset.media_id, cache_name, etag, data)
+    return data
+
+
+def _serve_manifest_asset(request, asset):
+    """
+    Build the response for a file listed in the site manifest.
+
+    Handles Accept-Encoding negotiation, conditional GETs (answered before
+    storage is touched) and single byte ranges (read with a ranged request).
+    Members of a site zip are read by range at their offset. Small files are served from the hot-asset cache when it is enabled.
+    With HTML_SITE_DELIVERY set to "accel" or "redirect" the body itself is
+    sent by nginx or the CDN.
+    """
+    range_header = request.headers.get("Range")
+    last_modified = int(asset.stored_at.timestamp())
+
+    # Prefer a precompressed copy the client can decode. Ranges always refer to
+    # the uncompressed file.
+    encoding, variant = None, None
+    if not range_header:
+        encoding, variant = _pick_variant(asset, _accepted_encodings(request))
+
+    # Each encoding is a different representation, so it needs its own ETag
+    etag = f'{asset.etag[:-1]}-{encoding}"' if variant else asset.etag
+    stored_name = variant["storage_key"] if variant else asset.storage_key
+    size = variant["size"] if variant else asset.size
+    offset = variant.get("offset") if variant else asset.offset
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+
+    # Members of a site zip have no object of their own to hand off
+    delivery = settings.HTML_SITE_DELIVERY if offset is None else "django"
+    if response is None and delivery != "django":
+        response = _offload_response(stored_name, delivery)
+        if delivery == "redirect":
+            # The bucket object carries its own type, encoding and validators
+            if asset.variants:
+                response["Vary"] = "Accept-Encoding"
+            return response
+
+        # nginx keeps these headers from this response when it serves the body
+        response["Content-Type"] = asset.content_type
+        if variant:
+            response["Content-Encoding"] = encoding
+        elif asset.encoding:
+            response["Content-Encoding"] = asset.encoding
+
+    byte_range = None
+    if response is None and range_header:
+        # A stale If-Range means the client's partial copy is outdated: send everything
+        if_range = request.headers.get("If-Range")
+        if not if_range or if_range in (etag, http_date(last_modified)):
+            try:
+                byte_range = _parse_range(range_header, size)
+            except _UnsatisfiableRange:
+                response = HttpResponse(status=416)
+                response["Content-Range"] = f"bytes */{size}"
+
+    if response is None:
+        data = _read_cached_asset(asset, stored_name, offset, etag, size)
+        if data is not None:
+            start, end = byte_range or (0, size - 1)
+            response = HttpResponse(data[start:end + 1], content_type=asset.content_type)
+        else:
+            start, end = byte_range or (None, None)
+            try:
+                file_obj = _open_asset_body(stored_name, offset, size, etag, start, end)
+            except Exception as e:
+                logger.error(f"Manifest entry {stored_name} could not be opened: {e}")
+                raise Http404("File not found")
+            response = FileResponse(file_obj, content_type=asset.content_type)
+
+        if byte_range:
+            response.status_code = 206
+            response["Content-Range"] = f"bytes {start}-{end}/{size}"
+            response["Content-Length"] = end - start + 1
+        else:
+            response["Content-Length"] = size
+
+        if variant:
+            response["Content-Encoding"] = encoding
+        elif asset.encoding:
+            response["Content-Encoding"] = asset.encoding
+
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    response["Accept-Ranges"] = "bytes"
+    if asset.variants:
+        response["Vary"] = "Accept-Encoding"
+    return response
+
+
+# "v<version>/<path>" under a versioned site's URL
+VERSION_PATH_RE = re.compile(r"v(\d+)(?:/(.*))?$", re.DOTALL)
+
+
+def _with_site_headers(response, content_type, immutable=False):
+    """Add the framing and caching headers of serve_html_site to ``response``."""
+    # Add security headers to allow loading assets from same origin
+    response["X-Frame-Options"] = "SAMEORIGIN"
+    response["Content-Security-Policy"] = "frame-ancestors 'self'"
+
+    # Add caching headers for better performance (makes the proxy fast!)
+    if not settings.DEBUG:
+        # For HTML files, cache for a short time (5 minutes)
+        # Redirects get the short lifetime too: their target changes on re-extraction
+        # Assets of a versioned site never change at their URL, so they are cached
+        # for good; those of unversioned sites for a long time (30 days)
+        if content_type == "text/html" or response.status_code == 302:
+            response["Cache-Control"] = "public, max-age=300"
+        elif immutable:
+            response["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            response["Cache-Control"] = "public, max-age=2592000"
+    else:
+        # Disable caching for development
+        response["Cache-Control"] = "no-cache, no-store, must-revalidate"
+        response["Pragma"] = "no-cache"
+        response["Expires"] = "0"
+
+    return response
+
+
+def _version_redirect(request, media_id, version, path):
+    """Redirect to ``path`` (relative to the site's base directory) in ``version`` of the site."""
+    url = reverse(
+        "media_library:serve_html_site_path",
+        kwargs={"media_id": media_id, "path": f"v{version}/{path or ''}"},
+    )
+    if request.META.get("QUERY_STRING"):
+        url = f"{url}?{request.META['QUERY_STRING']}"
+    return _with_site_headers(HttpResponseRedirect(url), None)
+
+
+def _is_within(base_dir, path):
+    """
+    Whether ``path`` is ``base_dir`` or below it. A plain prefix test would also
+    accept siblings such as ``html_sites/1/v10`` for ``html_sites/1/v1``.
+    """
+    try:
+        return os.path.commonpath([base_dir, path]) == os.path.normpath(base_dir)
+    except ValueError:  # one of them is absolute
+        return False
+
+
 def serve_html_site(request, media_id, path=""):
     """
     Serve HTML website files with proper path resolution and security headers.
     Works with both local and S3 storage.
     """
-    from django.core.files.storage import default_storage
-
     try:
-        media_file = get_object_or_404(MediaFile, pk=media_id)
+        # Routing data and manifest entries come from the per-process cache, so
+        # asset requests normally run no queries at all
+        site = get_site_route(int(media_id))
+        if site is None:
+            raise Http404("No MediaFile matches the given query.")
 
         # Ensure this is an HTML site
-        if not media_file.is_html or not media_file.html_base_dir:
+        if not site.is_html or not site.html_base_dir:
             raise Http404("Not an HTML website")
 
+        version = site.html_version
+        if site.html_version:
+            # Versioned sites are served under /v<version>/, so every URL names one
+            # extraction and never changes. Superseded versions are served for as
+            # long as they are kept (HTML_SITE_VERSION_GRACE), so pages loaded from
+            # them get their own assets; other URLs (the site's own, links to
+            # collected versions) lead to the same file in the live version.
+            match = VERSION_PATH_RE.match(path)
+            if match is None or not 0 < int(match[1]) <= site.html_version:
+                return _version_redirect(request, media_id, site.html_version, match[2] if match else path)
+            version = int(match[1])
+            # ".../v<version>" gets its slash, so relative URLs in the index resolve
+            if match[2] is None:
+                return _version_redirect(request, media_id, version, "")
+            path = match[2]
+        if version == site.html_version:
+            base_dir = site.html_base_dir
+        else:
+            base_dir = get_version_base_dir(int(media_id), version)
+            if base_dir is None:
+                # Collected already (or never finished)
+                return _version_redirect(request, media_id, site.html_version, path)
+
         # If no specific path is requested, serve the index.html
         if not path:
-            path = os.path.relpath(media_file.html_index_path, media_file.html_base_dir)
+            path = os.path.relpath(site.html_index_path, site.html_base_dir)
 
         # Construct the relative path within the storage
         # Note: default_storage uses paths relative to MEDIA_ROOT
-        relative_path = os.path.normpath(os.path.join(media_file.html_base_dir, path))
+        relative_path = os.path.normpath(os.path.join(base_dir, path))
 
         # Security check to prevent directory traversal attacks
-        if not relative_path.startswith(media_file.html_base_dir):
+        if not _is_within(base_dir, relative_path):
             raise Http404("Invalid path")
 
-        # Determine the content type
-        content_type, _ = mimetypes.guess_type(relative_path)
-        content_type = content_type or "application/octet-stream"
-
-        try:
-            # Create a response with the file content from storage
-            # We skip .exists() to reduce S3 latency (1 call instead of 2)
-            try:
-                # Try original path first
-                file_obj = default_storage.open(relative_path, "rb")
-                response = FileResponse(file_obj, content_type=content_type)
-            except Exception:
-                # Verge3D Fallback: Check if a compressed (.xz) version exists
-                # This handles files that were uploaded before the new renaming logic
-                if not relative_path.endswith(".xz"):
-                    xz_path = relative_path + ".xz"
-                    file_obj = default_storage.open(xz_path, "rb")
-                    response = FileResponse(file_obj, content_type=content_type)
-                    response["Content-Encoding"] = "xz"
-                else:
-                    raise
-        except Exception:
-            # If the file doesn't exist or S3 fails
+        # Answer from the site manifest: unknown paths are 404s and headers come
+        # from the manifest, so storage is only touched to read the bytes.
+        asset = get_site_asset(int(media_id), version, relative_path) if site.has_manifest else None
+        if asset is None and version != site.html_version:
+            # Not in a superseded version (any more)
+            return _version_redirect(request, media_id, site.html_version, path)
+        if asset is not None:
+            response = _serve_manifest_asset(request, asset)
+            content_type = asset.content_type
+        elif site.html_storage_mode != HTMLStorageMode.FILES or site.has_manifest:
             raise Http404("File not found")
-
-        # Add security headers to allow loading assets from same origin
-        response["X-Frame-Options"] = "SAMEORIGIN"
-        response["Content-Security-Policy"] = "frame-ancestors 'self'"
-
-        # Add caching headers for better performance (makes the proxy fast!)
-        if not settings.DEBUG:
-            # For assets (models, textures, scripts, etc.), cache for a long time (30 days)
-            # For HTML files, cache for a short time (5 minutes)
-            if content_type == "text/html":
-                response["Cache-Control"] = "public, max-age=300"
-            else:
-                response["Cache-Control"] = "public, max-age=2592000"
         else:
-            # Disable caching for development
-            response["Cache-Control"] = "no-cache, no-store, must-revalidate"
-            response["Pragma"] = "no-cache"
-            response["Expires"] = "0"
+            # Sites extracted before manifests existed (see the rebuild_html_sites
+            # command) are still looked up by path.
+            response, content_type = _serve_legacy_html_file(relative_path)
 
-        return response
+        return _with_site_headers(response, content_type, immutable=bool(site.html_version))
 
     except Http404:
         raise
     except Exception as e:
         logger.error(f"Error serving HTML site: {e}")
         raise Http404("Error serving HTML site")
+
+
+def serve_image_variant(request, media_id, source, width, height, fit, fmt):
+    """
+    Serve image ``media_id`` resized to ``width`` x ``height`` (see
+    renditions.variant_url, which signs these URLs).
+
+    Each variant is rendered once and stored; ImageVariant rows index the
+    stored ones, so a repeat request costs one query and a storage read.
+    The "auto" format is the smallest one the Accept header lists. URLs of a
+    file the image no longer has (``source``) redirect to the current file's.
+    """
+    signature = variant_signature(media_id, source, width, height, fit, fmt)
+    if not constant_time_compare(request.GET.get("s", ""), signature):
+        return HttpResponseForbidden("Invalid signature")
+    try:
+        check_variant(width, height, fit, fmt)
+    except ValueError as e:
+        raise Http404(str(e))
+
+    requested_fmt = fmt
+    negotiated = fmt == VARIANT_AUTO
+    if negotiated:
+        fmt = variant_format(request.headers.get("Accept", ""))
+
+    # Only variants of the image's current file
+    variant = ImageVariant.objects.filter(
+        media_id=media_id, source=F("media__file"), width=width, height=height, fit=fit, format=fmt
+    ).first()
+    if variant is not None:
+        file_name = variant.source
+    else:
+        file_name = MediaFile.objects.filter(pk=media_id, file_type="image").values_list("file", flat=True).first()
+        if file_name is None:
+            raise Http404("Image not found")
+    if not constant_time_compare(source, source_version(file_name)):
+        # The image was replaced since the URL was handed out
+        return HttpResponseRedirect(variant_url(media_id, file_name, width, height, fit, requested_fmt))
+
+    if variant is None:
+        try:
+            variant = get_or_render_variant(media_id, width, height, fit, fmt)
+        except Exception as e:
+            logger.error(f"Variant {width}x{height}/{fit}.{fmt} of media {media_id} could not be rendered: {e}")
+            raise Http404("Image could not be rendered")
+        if variant is None:
+            raise Http404("Image not found")
+
+    last_modified = int(variant.created_at.timestamp())
+    response = get_conditional_response(request, etag=variant.etag, last_modified=last_modified)
+    if response is None:
+        try:
+            file_obj = open_stream(variant.storage_key, version=variant.etag)
+        except Exception as e:
+            logger.error(f"Variant {variant.storage_key} could not be opened: {e}")
+            raise Http404("File not found")
+        response = FileResponse(file_obj, content_type=VARIANT_FORMATS[fmt][1])
+        response["Content-Length"] = variant.size
+
+    response["ETag"] = variant.etag
+    response["Last-Modified"] = http_date(last_modified)
+    response["Cache-Control"] = f"public, max-age={settings.IMAGE_VARIANT_MAX_AGE}"
+    if negotiated:
+        response["Vary"] = "Accept"
+    return response
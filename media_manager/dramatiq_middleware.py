@@ -0,0 +1,9 @@
+from django_dramatiq.apps import DjangoDramatiqConfig
+from dramatiq.middleware import group_callbacks
+
+
+class GroupCallbacks(group_callbacks.GroupCallbacks):
+    """dramatiq's GroupCallbacks, using the DRAMATIQ_RATE_LIMITER_BACKEND for its barriers."""
+
+    def __init__(self):
+        super().__init__(DjangoDramatiqConfig.get_rate_limiter_backend())
@@ -90,6 +90,9 @@ REST_FRAMEWORK = {
 USE_S3 = read_env("USE_S3", False, bool)
 
 if USE_S3:
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config
+
     AWS_ACCESS_KEY_ID = read_env("AWS_ACCESS_KEY_ID")
     AWS_SECRET_ACCESS_KEY = read_env("AWS_SECRET_ACCESS_KEY")
     AWS_STORAGE_BUCKET_NAME = read_env("AWS_STORAGE_BUCKET_NAME")
@@ -106,6 +109,36 @@ if USE_S3:
     AWS_S3_FILE_OVERWRITE = False
     AWS_S3_SIGNATURE_VERSION = "s3v4"
 
+    # One S3 client per process serves all of media_library's transfers (see
+    # media_library.storage.s3_client), so its pool must fit the concurrent serve and
+    # extraction traffic (HTML_SITE_UPLOAD_WORKERS x AWS_S3_MAX_CONCURRENCY while extracting)
+    AWS_S3_MAX_POOL_CONNECTIONS = read_env("AWS_S3_MAX_POOL_CONNECTIONS", 64, int)
+    AWS_S3_CONNECT_TIMEOUT = read_env("AWS_S3_CONNECT_TIMEOUT", 5, int)
+    AWS_S3_READ_TIMEOUT = read_env("AWS_S3_READ_TIMEOUT", 30, int)
+    # "standard" or "adaptive" (client-side rate limiting on throttling errors)
+    AWS_S3_RETRY_MODE = read_env("AWS_S3_RETRY_MODE", "standard")
+    AWS_S3_MAX_ATTEMPTS = read_env("AWS_S3_MAX_ATTEMPTS", 5, int)
+    AWS_S3_CLIENT_CONFIG = Config(
+        signature_version=AWS_S3_SIGNATURE_VERSION,
+        max_pool_connections=AWS_S3_MAX_POOL_CONNECTIONS,
+        tcp_keepalive=True,
+        connect_timeout=AWS_S3_CONNECT_TIMEOUT,
+        read_timeout=AWS_S3_READ_TIMEOUT,
+        retries={"mode": AWS_S3_RETRY_MODE, "total_max_attempts": AWS_S3_MAX_ATTEMPTS},
+    )
+
+    # Shared by the storage backend (MediaFile uploads) and media_library's own transfers:
+    # bodies above the threshold go up as parallel multipart uploads whose parts are retried
+    # individually
+    AWS_S3_MULTIPART_THRESHOLD = read_env("AWS_S3_MULTIPART_THRESHOLD", 16 * 1024 * 1024, int)
+    AWS_S3_MULTIPART_CHUNKSIZE = read_env("AWS_S3_MULTIPART_CHUNKSIZE", 8 * 1024 * 1024, int)
+    AWS_S3_MAX_CONCURRENCY = read_env("AWS_S3_MAX_CONCURRENCY", 4, int)
+    AWS_S3_TRANSFER_CONFIG = TransferConfig(
+        multipart_threshold=AWS_S3_MULTIPART_THRESHOLD,
+        multipart_chunksize=AWS_S3_MULTIPART_CHUNKSIZE,
+        max_concurrency=AWS_S3_MAX_CONCURRENCY,
+    )
+
     # Mega.io S4 requires the Account ID and Bucket Name in the URL path prefix.
     # django-storages uses AWS_S3_CUSTOM_DOMAIN to build asset URLs.
     if S3_ACCOUNT_ID and AWS_STORAGE_BUCKET_NAME:
@@ -113,9 +146,16 @@ if USE_S3:
             f"{AWS_S3_CUSTOM_DOMAIN}/{S3_ACCOUNT_ID}/{AWS_STORAGE_BUCKET_NAME}"
         )
 
+    # Optional read-through cache of media objects on local disk (empty dir disables it)
+    S3_DISK_CACHE_DIR = read_env("S3_DISK_CACHE_DIR", "")
+    S3_DISK_CACHE_MAX_BYTES = read_env("S3_DISK_CACHE_MAX_BYTES", 10 * 1024 * 1024 * 1024, int)
+    S3_DISK_CACHE_MAX_OBJECT = read_env("S3_DISK_CACHE_MAX_OBJECT", 256 * 1024 * 1024, int)
+
     STORAGES = {
         "default": {
-            "BACKEND": "storages.backends.s3.S3Storage",
+            "BACKEND": "media_library.storage.CachedS3Storage"
+            if S3_DISK_CACHE_DIR
+            else "storages.backends.s3.S3Storage",
             "OPTIONS": {
                 "location": os.path.join(AWS_LOCATION, "media")
                 if AWS_LOCATION
@@ -227,26 +267,37 @@ AUTH_PASSWORD_VALIDATORS = [
 
 
 # Dramatiq settings
+REDIS_URL = read_env("REDIS_SERVER", default="redis://localhost:6379/0")
+
 DRAMATIQ_BROKER = {
     "BROKER": "dramatiq.brokers.redis.RedisBroker",
     "OPTIONS": {
-        "url": read_env("REDIS_SERVER", default="redis://localhost:6379/0"),
+        "url": REDIS_URL,
     },
     "MIDDLEWARE": [
         "dramatiq.middleware.AgeLimit",
         "dramatiq.middleware.TimeLimit",
         "dramatiq.middleware.Callbacks",
         "dramatiq.middleware.Retries",
+        "media_manager.dramatiq_middleware.GroupCallbacks",
         "django_dramatiq.middleware.DbConnectionsMiddleware",
         "django_dramatiq.middleware.AdminMiddleware",
     ],
 }
 
+# Keeps track of group completion (sharded HTML site extraction)
+DRAMATIQ_RATE_LIMITER_BACKEND = {
+    "BACKEND": "dramatiq.rate_limits.backends.redis.RedisBackend",
+    "BACKEND_OPTIONS": {
+        "url": REDIS_URL,
+    },
+}
+
 # Defines which database should be used to store task results
 DRAMATIQ_RESULT_BACKEND = {
     "BACKEND": "dramatiq.results.backends.redis.RedisBackend",
     "BACKEND_OPTIONS": {
-        "url": read_env("REDIS_SERVER", default="redis://localhost:6379/0"),
+        "url": REDIS_URL,
     },
     "MIDDLEWARE_OPTIONS": {
         "result_ttl": 60000  # 1 minute
@@ -281,6 +332,79 @@ MEDIA_ROOT = BASE_DIR / "media"
 
 # Add to bottom of file
 IMAGEKIT_CACHEFILE_DIR = "thumbnails"
+# Renditions are rendered by a background task after upload, never inside a request
+IMAGEKIT_DEFAULT_CACHEFILE_STRATEGY = "media_library.renditions.Deferred"
+# Processes (per worker process) that decode and resize images for renditions
+IMAGE_RENDITION_PROCESSES = read_env("IMAGE_RENDITION_PROCESSES", 2, int)
+# Static file shown instead of a rendition that hasn't been rendered yet
+IMAGE_RENDITION_PLACEHOLDER = "media_library/img/rendition-placeholder.svg"
+# Largest width/height image variants (/media-library/img/...) can be requested at
+IMAGE_VARIANT_MAX_SIZE = read_env("IMAGE_VARIANT_MAX_SIZE", 4096, int)
+# How long clients may cache a variant. Variant URLs name the version of the source file,
+# so replacing an image gives it new URLs rather than waiting for this to run out
+IMAGE_VARIANT_MAX_AGE = read_env("IMAGE_VARIANT_MAX_AGE", 24 * 60 * 60, int)
+
+# HTML site (Verge3D) extraction
+# "files" stores every member under html_sites/{id}/ (directly addressable in the bucket),
+# "blobs" stores members content-addressed under html_blobs/ so identical files are kept once,
+# "zip" stores one uncompressed zip per site and serves members from it by byte range
+HTML_SITE_STORAGE_MODE = read_env("HTML_SITE_STORAGE_MODE", "files")
+# Members are piped to storage in chunks of this size
+HTML_SITE_CHUNK_SIZE = read_env("HTML_SITE_CHUNK_SIZE", 8 * 1024 * 1024, int)
+# Remote zips are copied into a spooled temp file that rolls over to disk past this size
+HTML_SITE_SPOOL_MAX_MEMORY = read_env("HTML_SITE_SPOOL_MAX_MEMORY", 16 * 1024 * 1024, int)
+HTML_SITE_MAX_MEMBERS = read_env("HTML_SITE_MAX_MEMBERS", 20000, int)
+HTML_SITE_MAX_UNCOMPRESSED_BYTES = read_env(
+    "HTML_SITE_MAX_UNCOMPRESSED_BYTES", 4 * 1024 * 1024 * 1024, int
+)
+# Verge3D .xz members are decompressed while streaming; this caps what a single one may expand to
+HTML_SITE_MAX_XZ_MEMBER_BYTES = read_env("HTML_SITE_MAX_XZ_MEMBER_BYTES", 1024 * 1024 * 1024, int)
+# Dramatiq time limit of the extraction task
+HTML_SITE_PROCESSING_TIMEOUT = read_env("HTML_SITE_PROCESSING_TIMEOUT", 60 * 60, int)
+# A processing worker renews its claim every fifth of this; a claim not renewed for this
+# long belongs to a crashed worker and may be taken over (resuming from its checkpoint)
+HTML_SITE_PROCESSING_LEASE = read_env("HTML_SITE_PROCESSING_LEASE", 5 * 60, int)
+# Failed extractions are retried (with backoff) this many times before the site is marked failed
+HTML_SITE_PROCESSING_RETRIES = read_env("HTML_SITE_PROCESSING_RETRIES", 3, int)
+# Extraction progress is published to Redis at most this often; the status stream
+# (server-sent events) holds a server thread per client, so it is opt-in
+HTML_SITE_PROGRESS_INTERVAL_MS = read_env("HTML_SITE_PROGRESS_INTERVAL_MS", 1000, int)
+HTML_SITE_PROGRESS_STREAM = read_env("HTML_SITE_PROGRESS_STREAM", False, bool)
+HTML_SITE_PROGRESS_STREAM_TIMEOUT = read_env("HTML_SITE_PROGRESS_STREAM_TIMEOUT", 5 * 60, int)
+# Each extraction is stored under a new version prefix; older versions are deleted this
+# long after a new one goes live, so pages loaded from them can still fetch their assets
+HTML_SITE_VERSION_GRACE = read_env("HTML_SITE_VERSION_GRACE", 60 * 60, int)
+# Archives of at least this many (uncompressed) bytes are extracted by several workers
+# at once, in batches of about HTML_SITE_SHARD_BATCH_BYTES; 0 never shards
+HTML_SITE_SHARD_MIN_BYTES = read_env("HTML_SITE_SHARD_MIN_BYTES", 1024 * 1024 * 1024, int)
+HTML_SITE_SHARD_BATCH_BYTES = read_env("HTML_SITE_SHARD_BATCH_BYTES", 256 * 1024 * 1024, int)
+# Members are uploaded by a thread pool; producers block once this many bytes are in flight
+HTML_SITE_UPLOAD_WORKERS = read_env("HTML_SITE_UPLOAD_WORKERS", 8, int)
+HTML_SITE_UPLOAD_MAX_INFLIGHT_BYTES = read_env(
+    "HTML_SITE_UPLOAD_MAX_INFLIGHT_BYTES", 64 * 1024 * 1024, int
+)
+HTML_SITE_UPLOAD_RETRIES = read_env("HTML_SITE_UPLOAD_RETRIES", 3, int)
+# Store .gz (and .br, if the Brotli package is installed) copies of text assets
+HTML_SITE_PRECOMPRESS = read_env("HTML_SITE_PRECOMPRESS", True, bool)
+HTML_SITE_PRECOMPRESS_MIN_SIZE = read_env("HTML_SITE_PRECOMPRESS_MIN_SIZE", 1024, int)
+HTML_SITE_BROTLI_QUALITY = read_env("HTML_SITE_BROTLI_QUALITY", 9, int)
+# How serve_html_site sends asset bodies once Django has checked the request:
+# "django" streams them from the worker, "accel" hands them to nginx with X-Accel-Redirect
+# (HTML_SITE_ACCEL_PREFIX must be an internal location mapping to the storage root, see
+# nginx/nginx.conf), "redirect" answers with a 302 to the storage/CDN URL
+HTML_SITE_DELIVERY = read_env("HTML_SITE_DELIVERY", "django")
+HTML_SITE_ACCEL_PREFIX = read_env("HTML_SITE_ACCEL_PREFIX", "/internal-s3/")
+# Each process keeps the routing data of this many sites, and the manifest entries of this
+# many files, for up to TTL seconds (0 disables); changes are pushed to all processes over
+# Redis pub/sub
+HTML_SITE_ROUTE_CACHE_SIZE = read_env("HTML_SITE_ROUTE_CACHE_SIZE", 256, int)
+HTML_SITE_ASSET_INDEX_SIZE = read_env("HTML_SITE_ASSET_INDEX_SIZE", 10000, int)
+HTML_SITE_ROUTE_CACHE_TTL = read_env("HTML_SITE_ROUTE_CACHE_TTL", 60, int)
+# Bodies of small assets served by Django can be kept in memory, up to this many bytes per
+# process (0 disables) and files of at most MAX_OBJECT bytes
+HTML_SITE_ASSET_CACHE_BYTES = read_env("HTML_SITE_ASSET_CACHE_BYTES", 0, int)
+HTML_SITE_ASSET_CACHE_MAX_OBJECT = read_env("HTML_SITE_ASSET_CACHE_MAX_OBJECT", 512 * 1024, int)
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 